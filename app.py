@@ -1,13 +1,14 @@
 import streamlit as st
 import pandas as pd
-import plotly.graph_objects as go
 import time
 import datetime
 import extra_streamlit_components as stx
 from supabase import create_client, Client
 import price_engine
-import ccxt
+import storage
+import metrics
 import os
+import tempfile
 
 # ==========================================
 # 1. 页面配置与 CSS
@@ -71,6 +72,8 @@ try:
 
     # 4. Connect
     supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+    # 5. 数据后端: 默认就是 Supabase；STORAGE_BACKEND=sqlite 时读写走本地 SQLite，登录仍用 Supabase Auth
+    db = metrics.instrument_client(storage.open_storage(supabase))
 
 except Exception as e:
     st.error(f"Database Connection Error: {e}")
@@ -89,6 +92,11 @@ if 'session' in st.session_state:
 # ==========================================
 # 3. 辅助函数
 # ==========================================
+@st.cache_resource
+def start_metrics_server(port):
+    # 每个进程只起一次 /metrics (Prometheus 文本格式)
+    return metrics.serve(port)
+
 def render_hud(title, val, sub, theme="blue"):
     return f"""
     <div class="hud-card glow-{theme}">
@@ -138,11 +146,29 @@ def main_app():
     # 第一次获取数据（主要为了给 Sidebar 使用）
     try:
         market_static = price_engine.get_market_data_instance()
-        raw_static = price_engine.get_user_portfolio(supabase)
-        df_static = price_engine.calculate_dashboard_data(raw_static, market_static)
-    except:
+        raw_static = price_engine.get_user_portfolio(db, user.id)
+        df_static, _ = price_engine.calculate_dashboard_data(raw_static, market_static)
+    except Exception as e:
+        metrics.error("app:sidebar_portfolio", e)
         df_static = pd.DataFrame()
 
+    # --- 后台同步进度 (只刷新这一小块，不阻塞页面) ---
+    @st.fragment(run_every=2)
+    def sync_jobs_panel():
+        runner = price_engine.get_job_runner()
+        for job in runner.jobs_for(user.id):
+            _, ex, _ = job.key
+            p = job.progress
+            if job.active:
+                total = p.get('markets_total') or p.get('assets_total') or 0
+                done = p.get('markets_done', 0) if 'markets_total' in p else p.get('assets_written', 0)
+                label = f"{ex.upper()} {job.kind}: {job.status} {done}/{total}" if total else f"{ex.upper()} {job.kind}: {job.status}"
+                st.progress(min(done / total, 1.0) if total else 0.0, text=label)
+                if p.get('trades_written'): st.caption(f"{p['trades_written']} trades written")
+                if st.button("CANCEL", key=f"cancel_{ex}_{job.kind}"): runner.cancel(job.key)
+            elif job.status == "done": st.caption(f"✅ {ex.upper()} {job.kind}: {job.message}")
+            else: st.caption(f"⚠️ {ex.upper()} {job.kind}: {job.message}")
+
     # --- Sidebar (静态) ---
     with st.sidebar:
         st.markdown("### ⚙ CONTROL PANEL")
@@ -160,7 +186,7 @@ def main_app():
                 if st.form_submit_button("SAVE ASSET"):
                     try:
                         amt = float(amt_str); avg = float(avg_str)
-                        price_engine.upsert_user_asset(supabase, user.id, sym, amt, avg)
+                        price_engine.upsert_user_asset(db, user.id, sym, amt, avg)
                         st.toast("Asset Saved"); time.sleep(0.5); st.rerun()
                     except: st.error("Invalid Number")
                     
@@ -177,6 +203,7 @@ def main_app():
                 password = st.text_input("Passphrase", value=str(c_pass) if c_pass else "", type="password")
             
             remember = st.checkbox("Remember Keys")
+            runner = price_engine.get_job_runner()
             
             col1, col2 = st.columns(2)
             with col1:
@@ -186,16 +213,13 @@ def main_app():
                         cookie_manager.set(f"{exchange}_key", api_key, expires_at=exp)
                         cookie_manager.set(f"{exchange}_sec", api_sec, expires_at=exp)
                         if password: cookie_manager.set(f"{exchange}_pass", password, expires_at=exp)
-                    with st.spinner("Connecting..."):
-                        ok, msg = price_engine.sync_exchange_holdings(supabase, user.id, exchange, api_key, api_sec, password)
-                        if ok: st.success("Updated"); time.sleep(1); st.rerun()
-                        else: st.error(msg)
+                    runner.submit((user.id, exchange, "balance"), "BAL", price_engine.sync_exchange_holdings, db, user.id, exchange, api_key, api_sec, password)
+                    st.toast("Balance sync queued")
             with col2:
                 if st.button("SYNC LOG"):
-                    with st.spinner("Fetching Log..."):
-                        ok, msg = price_engine.sync_history_log(supabase, user.id, exchange, api_key, api_sec, password)
-                        if ok: st.success("Done"); time.sleep(1); st.rerun()
-                        else: st.error(msg)
+                    runner.submit((user.id, exchange, "history"), "LOG", price_engine.sync_history_log, db, user.id, exchange, api_key, api_sec, password)
+                    st.toast("History sync queued")
+            sync_jobs_panel()
             if st.button("Clear Saved Keys"):
                 cookie_manager.delete(f"{exchange}_key"); cookie_manager.delete(f"{exchange}_sec"); 
                 if password: cookie_manager.delete(f"{exchange}_pass")
@@ -204,24 +228,38 @@ def main_app():
         st.divider()
 
         with st.expander("🎯 TAX & GOAL", expanded=False):
-            cur = price_engine.get_user_goal(supabase, user.id)
+            cur = price_engine.get_user_goal(db, user.id)
             new = st.number_input("Target $", value=float(cur), step=5000.0)
             if 'tax_rate' not in st.session_state: st.session_state.tax_rate = 30.0
             st.session_state.tax_rate = st.slider("Tax Rate %", 0.0, 50.0, st.session_state.tax_rate)
-            if st.button("SAVE GOAL"): price_engine.upsert_user_goal(supabase, user.id, new); st.rerun()
+            if 'lot_method' not in st.session_state: st.session_state.lot_method = "FIFO"
+            st.session_state.lot_method = st.selectbox("Lot Method", price_engine.LOT_METHODS, index=price_engine.LOT_METHODS.index(st.session_state.lot_method))
+            if st.button("SAVE GOAL"): price_engine.upsert_user_goal(db, user.id, new); st.rerun()
 
         with st.expander("🗑️ MANAGE ASSETS", expanded=False):
             asset_list = [row['Symbol'] for row in df_static.to_dict('records')] if not df_static.empty else []
             if asset_list:
                 to_del = st.selectbox("Select Asset to Delete", asset_list)
                 if st.button(f"DELETE {to_del}", type="secondary"):
-                    price_engine.delete_user_asset(supabase, user.id, to_del)
+                    price_engine.delete_user_asset(db, user.id, to_del)
                     st.toast("Deleted"); time.sleep(0.5); st.rerun()
                 st.write("")
                 if st.button("⚠️ RESET PORTFOLIO", type="primary"):
-                    price_engine.reset_user_portfolio(supabase, user.id)
+                    price_engine.reset_user_portfolio(db, user.id)
                     st.success("Cleared"); time.sleep(0.5); st.rerun()
             else: st.caption("No assets to manage.")
+            if st.button("🔧 REBUILD COST BASIS"):
+                price_engine.rebuild_cost_basis(db, user.id)
+                st.success("Rebuilt"); time.sleep(0.5); st.rerun()
+
+        if metrics.ENABLED:
+            with st.expander("📈 DIAGNOSTICS", expanded=False):
+                timings, counts, errors = metrics.summary()
+                if timings: st.dataframe(pd.DataFrame(timings), hide_index=True, use_container_width=True,
+                                         column_config={"avg_ms": st.column_config.NumberColumn(format="%.2f"), "max_ms": st.column_config.NumberColumn(format="%.2f")})
+                if counts: st.dataframe(pd.DataFrame(counts), hide_index=True, use_container_width=True)
+                if errors: st.dataframe(pd.DataFrame(errors), hide_index=True, use_container_width=True)
+                if not (timings or counts or errors): st.caption("No metrics yet.")
 
         st.write("")
         if st.button("LOGOUT"): supabase.auth.sign_out(); st.session_state.user = None; st.rerun()
@@ -230,27 +268,31 @@ def main_app():
     #  🔥 局部刷新区域 (Fragment)
     # =========================================================
     @st.fragment(run_every=10)
+    @metrics.rerun_scope("live_panel")
     def live_dashboard_panel():
         try:
             m_data = price_engine.get_market_data_instance()
-            raw_data = price_engine.get_user_portfolio(supabase)
-            df = price_engine.calculate_dashboard_data(raw_data, m_data)
-        except:
-            df = pd.DataFrame()
-
-        val = df['Current Value'].sum() if not df.empty else 0
-        cost = (df['Amount'] * df['Avg Buy Price']).sum() if not df.empty else 0
-        pnl = val - cost
-        pct = (pnl/cost*100) if cost>0 else 0
-        goal = price_engine.get_user_goal(supabase, user.id)
+            raw_data = price_engine.get_user_portfolio(db, user.id)
+            df, totals = price_engine.calculate_dashboard_data(raw_data, m_data)
+        except Exception as e:
+            metrics.error("app:live_panel", e)
+            df, totals = pd.DataFrame(), dict(price_engine.EMPTY_TOTALS)
+
+        val, pnl, pct = totals['net_worth'], totals['pnl'], totals['pnl_pct']
+        try: day_chg, day_pct, covered = price_engine.calculate_period_change(df, m_data, 86400)
+        except Exception as e: metrics.error("app:period_change", e); day_chg, day_pct, covered = 0.0, 0.0, 0.0
+        goal = price_engine.get_user_goal(db, user.id)
         goal_pct = min((val/goal*100), 100) if goal>0 else 0
         est_tax = max(pnl * (st.session_state.get('tax_rate', 30.0)/100), 0)
 
         st.markdown("### 📡 SYSTEM STATUS: ONLINE (AUTO-SYNCING)")
         
         c1, c2, c3 = st.columns(3)
-        with c1: st.markdown(render_hud("NET WORTH", f"${val:,.2f}", "TOTAL ASSETS", "blue"), unsafe_allow_html=True)
-        with c2: st.markdown(render_hud("24H P&L", f"${pnl:,.2f}", f"{pct:+.2f}%", "green" if pnl>=0 else "red"), unsafe_allow_html=True)
+        with c1: st.markdown(render_hud("NET WORTH", f"${val:,.2f}", f"TOTAL P&L ${pnl:+,.2f} ({pct:+.2f}%)", "blue"), unsafe_allow_html=True)
+        with c2:
+            # 服务刚启动时历史不满 24 小时，标出实际覆盖的时长
+            day_sub = f"{day_pct:+.2f}%" if covered >= 86000 else f"{day_pct:+.2f}% (LAST {covered/3600:.1f}H)"
+            st.markdown(render_hud("24H P&L", f"${day_chg:,.2f}", day_sub, "green" if day_chg>=0 else "red"), unsafe_allow_html=True)
         with c3: 
             t_c = "red" if est_tax > 0 else "green"
             st.markdown(render_hud("EST. TAX BILL", f"${est_tax:,.2f}", "LIABILITY ALERT", t_c), unsafe_allow_html=True)
@@ -268,6 +310,9 @@ def main_app():
         with c_left:
             st.markdown("#### 📊 LIVE POSITIONS")
             if not df.empty:
+                # 15 分钟一根的 24 小时走势，直接来自内存里的价格历史
+                df['24H'] = [m_data.ohlc(s, 900)['close'].tolist() for s in df['Symbol']]
+
                 def color_pnl(val):
                     color = '#00ff41' if val >= 0 else '#ff003c'
                     return f'color: {color}; font-weight: bold;'
@@ -277,18 +322,20 @@ def main_app():
                     "Avg Buy Price": "${:,.2f}",
                     "Current Price": "${:,.2f}",
                     "Current Value": "${:,.2f}",
+                    "P&L": "${:+,.2f}",
                     "P&L %": "{:+.2f}%"
-                }).map(color_pnl, subset=['P&L %'])
+                }).map(color_pnl, subset=['P&L', 'P&L %'])
 
                 st.dataframe(
                     styled_df,
-                    column_order=['Symbol', 'Amount', 'Avg Buy Price', 'Current Price', 'Current Value', 'P&L %'],
+                    column_order=['Symbol', 'Amount', 'Avg Buy Price', 'Current Price', '24H', 'Current Value', 'P&L', 'P&L %'],
                     hide_index=True, 
                     use_container_width=True,
                     height=400,
                     column_config={
                         "Symbol": "Asset", "Amount": "Holdings", "Avg Buy Price": "Avg Buy",
-                        "Current Price": "Price", "Current Value": "Value", "P&L %": "Performance"
+                        "Current Price": "Price", "Current Value": "Value", "P&L": "P&L", "P&L %": "Performance",
+                        "24H": st.column_config.LineChartColumn("24H")
                     }
                 )
             else: st.info("Waiting for data / No Assets...")
@@ -296,6 +343,7 @@ def main_app():
         with c_right:
             st.markdown("#### 🍩 ALLOCATION")
             if not df.empty:
+                import plotly.graph_objects as go  # 只有这张饼图用 plotly，登录页和空仓位不用加载
                 fig = go.Figure(data=[go.Pie(labels=df['Symbol'], values=df['Current Value'], hole=.6)])
                 fig.update_layout(paper_bgcolor='rgba(0,0,0,0)', plot_bgcolor='rgba(0,0,0,0)', showlegend=False, margin=dict(t=0,b=0,l=0,r=0), height=300)
                 energy_gradient = ['#5affd6', '#00ff41', '#00d135', '#00a329', '#00751d']
@@ -311,6 +359,46 @@ def main_app():
     live_dashboard_panel()
     
     st.markdown("---"); st.markdown("### 🏛 THE TAX ENGINE")
+
+    # --- 账本: 过滤/排序/分页都在数据库端，一次只拉一页；翻页只重跑这个 fragment ---
+    @st.fragment
+    @metrics.rerun_scope("ledger_panel")
+    def ledger_panel():
+        f1, f2, f3, f4 = st.columns([2, 2, 3, 2])
+        sym_filter = f1.text_input("SYMBOLS", placeholder="BTC, ETH", key="lg_sym")
+        type_filter = f2.multiselect("TYPE", ["BUY", "SELL"], key="lg_type")
+        dates = f3.date_input("DATE RANGE", value=(), key="lg_dates")
+        sort = f4.selectbox("SORT BY", price_engine.LEDGER_SORT_COLUMNS, key="lg_sort")
+        desc = st.toggle("Newest / largest first", value=True, key="lg_desc")
+        symbols = [s.strip().upper() for s in sym_filter.split(",") if s.strip()]
+        start = dates[0] if len(dates) > 0 else None
+        end = dates[1] if len(dates) > 1 else start
+        # 条件一变就回到第一页
+        filters = (tuple(symbols), tuple(type_filter), start, end, sort, desc)
+        if st.session_state.get('lg_filters') != filters:
+            st.session_state.lg_filters = filters; st.session_state.lg_page = 0
+        page = st.session_state.get('lg_page', 0)
+
+        try: page_df, total = price_engine.get_ledger_page(db, user.id, page, sort=sort, descending=desc, symbols=symbols, types=type_filter, start=start, end=end)
+        except Exception as e: page_df, total = pd.DataFrame(), 0; st.error(f"❌ Error: {e}")
+        pages = max((total - 1) // price_engine.LEDGER_PAGE_SIZE + 1, 1)
+        if page_df.empty:
+            st.info("No matching records."); return
+
+        view = page_df.assign(timestamp=pd.to_datetime(page_df['timestamp']).dt.strftime('%Y-%m-%d %H:%M'))
+        grid = st.dataframe(view[['timestamp', 'type', 'symbol', 'quantity', 'price', 'exchange']], hide_index=True, use_container_width=True,
+                            on_select="rerun", selection_mode="multi-row", key=f"lg_grid_{page}",
+                            column_config={"quantity": st.column_config.NumberColumn("QTY", format="%.4f"),
+                                           "price": st.column_config.NumberColumn("PRICE", format="$%.2f")})
+        selected = page_df['id'].iloc[grid.selection.rows].tolist()
+
+        n1, n2, n3, n4 = st.columns([1, 2, 1, 2])
+        if n1.button("◀", disabled=page == 0, key="lg_prev"): st.session_state.lg_page = page - 1; st.rerun(scope="fragment")
+        n2.caption(f"Page {page + 1} / {pages} · {total} records")
+        if n3.button("▶", disabled=page >= pages - 1, key="lg_next"): st.session_state.lg_page = page + 1; st.rerun(scope="fragment")
+        if n4.button(f"🗑️ DELETE SELECTED ({len(selected)})", disabled=not selected, key="lg_del"):
+            n = price_engine.delete_transactions(db, user.id, selected)
+            st.toast(f"Deleted {n} records"); time.sleep(0.5); st.rerun()
     
     with st.expander("➕ Manual Tax Record"):
         with st.form("t_rec"):
@@ -324,24 +412,29 @@ def main_app():
             if st.form_submit_button("ADD"):
                 try:
                     tq = float(tq_str); tp = float(tp_str)
-                    price_engine.add_transaction(supabase, user.id, ts, tt, tq, tp, td)
+                    price_engine.add_transaction(db, user.id, ts, tt, tq, tp, td)
                     st.success("Recorded"); time.sleep(0.5); st.rerun()
                 except Exception as e: st.error(f"❌ Error: {e}")
 
-    tx_df = price_engine.get_transaction_history(supabase, user.id)
-    if not tx_df.empty:
-        calc = price_engine.TaxCalculator()
-        realized, events = calc.calculate(tx_df)
+    try: tx_count = price_engine.count_transactions(db, user.id)
+    except Exception as e: metrics.error("app:count_transactions", e); tx_count = 0
+    if tx_count:
+        lot_method = st.session_state.get('lot_method', "FIFO")
+        calc = price_engine.TaxCalculator(lot_method)
+        try: realized, events = calc.refresh(db, user.id)
+        except Exception as e:
+            metrics.error("app:tax_refresh", e)
+            realized, events = calc.calculate(price_engine.get_transaction_history(db, user.id))
         
         col_res, col_del = st.columns([3, 1])
         with col_res:
-            st.markdown(f"<div style='color:#fff; margin-bottom:10px;'>REALIZED P&L: <span style='color:{'#00ff41' if realized>0 else '#ff003c'}'>${realized:,.2f}</span> (FIFO)</div>", unsafe_allow_html=True)
+            st.markdown(f"<div style='color:#fff; margin-bottom:10px;'>REALIZED P&L: <span style='color:{'#00ff41' if realized>0 else '#ff003c'}'>${realized:,.2f}</span> ({lot_method})</div>", unsafe_allow_html=True)
         with col_del:
             if st.button("🗑️ CLEAR HISTORY"):
-                price_engine.clear_all_transactions(supabase, user.id)
+                price_engine.clear_all_transactions(db, user.id)
                 st.success("Cleared"); time.sleep(0.5); st.rerun()
 
-        t1, t2 = st.tabs(["💰 TAX EVENTS", "📜 FULL LEDGER"])
+        t1, t2, t3 = st.tabs(["💰 TAX EVENTS", "📜 FULL LEDGER", "📄 REPORT"])
         with t1:
             if events:
                 for e in reversed(events[-5:]):
@@ -355,15 +448,32 @@ def main_app():
                     """, unsafe_allow_html=True)
             else: st.info("No taxable events yet.")
         with t2:
-            st.caption("Click X to delete specific record")
-            for index, row in tx_df.sort_values('timestamp', ascending=False).iterrows():
-                c1, c2, c3, c4, c5 = st.columns([2, 1, 2, 2, 1])
-                ts_str = pd.to_datetime(row['timestamp']).strftime('%Y-%m-%d')
-                c1.write(ts_str); c2.write(row['type']); c3.write(f"{row['symbol']}"); c4.write(f"{float(row['quantity']):.4f} @ ${float(row['price']):,.0f}")
-                if c5.button("❌", key=f"del_{row['id']}"): price_engine.delete_transaction(supabase, row['id']); st.rerun()
+            ledger_panel()
+        with t3:
+            # 8949 明细按块流式写到临时文件，生成完再提供下载
+            r1, r2 = st.columns(2)
+            this_year = datetime.date.today().year
+            year = r1.selectbox("TAX YEAR", list(range(this_year, this_year - 10, -1)), index=1)
+            fmt = r2.radio("FORMAT", ["csv", "parquet"], horizontal=True)
+            if st.button("GENERATE REPORT"):
+                path = os.path.join(tempfile.gettempdir(), f"tax_{user.id}_{year}_{lot_method}.{fmt}")
+                with st.spinner("Matching lots..."):
+                    try:
+                        n = price_engine.export_tax_report(db, user.id, path, fmt, lot_method, year)
+                        st.session_state.tax_report = (path, n)
+                    except Exception as e: st.error(f"❌ Error: {e}")
+            report = st.session_state.get('tax_report')
+            if report and os.path.exists(report[0]):
+                path, n = report
+                st.caption(f"{n} disposals · {lot_method}")
+                with open(path, "rb") as f:
+                    st.download_button("⬇️ DOWNLOAD", f, file_name=os.path.basename(path).replace(f"_{user.id}", ""),
+                                       mime="text/csv" if path.endswith(".csv") else "application/octet-stream")
     else:
         st.info("No transaction history.")
 
 if __name__ == "__main__":
-    if st.session_state.user: main_app()
+    if metrics.ENABLED and os.environ.get("METRICS_PORT"): start_metrics_server(int(os.environ["METRICS_PORT"]))
+    if st.session_state.user:
+        with metrics.rerun_scope("app"): main_app()
     else: login_ui()
\ No newline at end of file
@@ -0,0 +1,222 @@
+"""
+无界面批处理: 全部用户对着同一份价格快照算一遍面板汇总和已实现盈亏，结果批量写进 user_snapshots 表。
+给夜间任务用 (税务快照、目标进度邮件、对账)，不用再一个个用户去开 Streamlit 页面。
+
+跑一遍:      python batch.py                       (Supabase 需要 SUPABASE_URL + service role 的 SUPABASE_KEY，否则 RLS 只让看到自己)
+本地库:      STORAGE_BACKEND=sqlite SQLITE_PATH=crypto_quant.db python batch.py --workers 8
+只算不写:    python batch.py --dry-run
+换配对方法:  python batch.py --method HIFO
+
+流程: 持仓整表分页读进来 (顺便得到要报价的币种) -> 抓一次价格快照 -> 成交按用户顺序分页流式读出，
+攒成批交给进程池 (每个进程启动时拿一份快照，之后只收持仓和成交) -> 结果攒够一块就一次 upsert。
+as_of 是运行当天 (UTC) 的日期: 持仓表只有当前余额、价格是当前快照，算不了过去某天，同一天重跑按 (user_id, as_of) 覆盖。
+"""
+import argparse
+import datetime
+import itertools
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from types import MappingProxyType
+
+import pandas as pd
+
+import metrics
+import price_engine
+import storage
+
+TASK_USERS = 200         # 每个进程池任务最多带多少个用户
+TASK_ROWS = 50_000       # ...或者最多多少行成交，先到哪个算哪个
+WRITE_CHUNK = 500        # 结果每攒够这么多行写一次
+SNAPSHOT_WAIT = 10       # 抓价时最多等慢交易所多久 (秒)
+
+
+# ==========================================
+# 1. 批量读
+# ==========================================
+def scan(db, table, columns, keys, where=None):
+    """按 keys 排序 keyset 分页读整张表，逐行产出；where(query) 可以再加过滤条件"""
+    build = lambda: where(db.table(table).select(columns)) if where else db.table(table).select(columns)
+    for rows in price_engine.iter_pages(build, keys): yield from rows
+
+def load_portfolios(db):
+    """{user_id: [持仓行]}；持仓表每个用户每个币种一行，整表放得进内存"""
+    out = {}
+    for row in scan(db, "user_portfolios", "id, user_id, symbol, amount, avg_buy_price", ("id",)):
+        out.setdefault(row['user_id'], []).append(row)
+    return out
+
+def load_goals(db):
+    """{user_id: 净值目标}；没设过的用户不在里面，和界面一样按 DEFAULT_NET_WORTH_GOAL 算"""
+    return {row['user_id']: float(row['net_worth_goal']) for row in scan(db, "user_settings", "user_id, net_worth_goal", ("user_id",))
+            if row['net_worth_goal'] is not None}
+
+def iter_users(db, portfolios):
+    """按用户产出 (user_id, 持仓行, 成交行)。成交按 (用户, 币种, 时间, id) 顺序流式读，
+    同一用户的成交在结果里是连续的；没有成交只有持仓的用户最后补上"""
+    seen = set()
+    txs = scan(db, "transactions", "id, user_id, symbol, type, quantity, price, timestamp, trade_id",
+               ("user_id", "symbol", "timestamp", "id"), where=lambda q: q.in_("type", ["BUY", "SELL"]))
+    for user_id, rows in itertools.groupby(txs, key=lambda r: r['user_id']):
+        seen.add(user_id)
+        yield user_id, portfolios.get(user_id, []), list(rows)
+    for user_id, holdings in portfolios.items():
+        if user_id not in seen: yield user_id, holdings, []
+
+def iter_tasks(users, max_users=TASK_USERS, max_rows=TASK_ROWS):
+    """把用户攒成进程池任务，每个任务的成交行数大致均匀"""
+    batch, rows = [], 0
+    for user in users:
+        batch.append(user)
+        rows += len(user[2])
+        if len(batch) >= max_users or rows >= max_rows:
+            yield batch
+            batch, rows = [], 0
+    if batch: yield batch
+
+
+# ==========================================
+# 2. 价格快照
+# ==========================================
+def take_price_snapshot(symbols, exchanges):
+    """用一个不起后台线程的 MarketData 抓一轮价，返回 {报价键: 价格}"""
+    md = price_engine.MarketData(exchanges=exchanges, autostart=False)
+    md.update_targets(symbols)
+    md._update_cycle()
+    # 本轮没等到的慢交易所结果落地后再折算一次交叉汇率
+    wait([v.pending for v in md.venues if v.pending is not None], timeout=SNAPSHOT_WAIT)
+    md._derive_cross_rates()
+    md.running = False
+    md.pool.shutdown(wait=False)
+    return dict(md.snapshot.prices)
+
+class FrozenMarket:
+    """只读的价格快照，提供 calculate_dashboard_data 用到的那部分 MarketData 接口"""
+    def __init__(self, prices, published_at=None):
+        self.snapshot = price_engine.PriceSnapshot(1, MappingProxyType(prices), MappingProxyType({}), published_at or time.time())
+
+    def update_targets(self, symbols_list):
+        pass
+
+    get_price = price_engine.MarketData.get_price
+    get_prices = price_engine.MarketData.get_prices
+
+
+# ==========================================
+# 3. 逐用户计算 (在进程池里跑)
+# ==========================================
+_market = None
+_calc = None
+
+def _init_worker(prices, method):
+    # 快照在每个进程启动时传一次，之后的任务只带用户数据
+    global _market, _calc
+    _market = FrozenMarket(prices)
+    _calc = price_engine.TaxCalculator(method)
+
+def evaluate_user(user_id, holdings, transactions, goal, market, calc, as_of):
+    df, totals = price_engine.calculate_dashboard_data(holdings, market)
+    realized, events = calc.calculate(pd.DataFrame(transactions)) if transactions else (0.0, [])
+    return {
+        'user_id': user_id, 'as_of': as_of,
+        'net_worth': totals['net_worth'], 'cost': totals['cost'], 'pnl': totals['pnl'], 'pnl_pct': totals['pnl_pct'],
+        'positions': len(df), 'realized_pnl': float(realized), 'tax_events': len(events),
+        'net_worth_goal': goal, 'goal_pct': totals['net_worth'] / goal * 100 if goal else None,
+        'computed_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+    }
+
+def evaluate_batch(batch, as_of):
+    """一个任务: [(user_id, 持仓, 成交, 目标)] -> (结果行, 失败的用户)"""
+    rows, failed = [], []
+    for user_id, holdings, transactions, goal in batch:
+        try: rows.append(evaluate_user(user_id, holdings, transactions, goal, _market, _calc, as_of))
+        except Exception as e: failed.append((user_id, f"{type(e).__name__}: {e}"))
+    return rows, failed
+
+
+# ==========================================
+# 4. 调度 & 批量写
+# ==========================================
+def write_results(db, rows):
+    for i in range(0, len(rows), WRITE_CHUNK):
+        db.table("user_snapshots").upsert(rows[i:i + WRITE_CHUNK], on_conflict="user_id, as_of").execute()
+
+def run(db, exchanges=('kraken',), workers=None, method='FIFO', dry_run=False, prices=None):
+    """全部用户跑一遍，返回统计 dict；prices 传进来就不再抓价 (测试、复算)"""
+    as_of = datetime.datetime.now(datetime.timezone.utc).date().isoformat()
+    workers = workers or os.cpu_count() or 1
+    started = time.perf_counter()
+    portfolios = load_portfolios(db)
+    goals = load_goals(db)
+    if prices is None:
+        symbols = sorted({r['symbol'] for rows in portfolios.values() for r in rows if (r.get('amount') or 0) > 0})
+        prices = take_price_snapshot(symbols, exchanges)
+    priced_at = time.perf_counter()
+
+    stats = {'users': 0, 'transactions': 0, 'written': 0, 'failed': []}
+    pending_rows = []
+
+    def collect(result):
+        rows, failed = result
+        stats['users'] += len(rows)
+        stats['failed'].extend(failed)
+        pending_rows.extend(rows)
+        if len(pending_rows) >= WRITE_CHUNK and not dry_run:
+            write_results(db, pending_rows)
+            stats['written'] += len(pending_rows)
+            pending_rows.clear()
+
+    def tasks():
+        for batch in iter_tasks(iter_users(db, portfolios)):
+            stats['transactions'] += sum(len(u[2]) for u in batch)
+            yield [(u, h, t, goals.get(u, price_engine.DEFAULT_NET_WORTH_GOAL)) for u, h, t in batch]
+
+    if workers <= 1:
+        _init_worker(prices, method)
+        for batch in tasks(): collect(evaluate_batch(batch, as_of))
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(prices, method)) as pool:
+            # 在途任务数有上限，读库不会跑到计算前面太远，内存只和在途的用户数有关
+            inflight = set()
+            for batch in tasks():
+                inflight.add(pool.submit(evaluate_batch, batch, as_of))
+                if len(inflight) >= workers * 2:
+                    done, inflight = wait(inflight, return_when=FIRST_COMPLETED)
+                    for fut in done: collect(fut.result())
+            for fut in inflight: collect(fut.result())
+    if pending_rows and not dry_run:
+        write_results(db, pending_rows)
+        stats['written'] += len(pending_rows)
+
+    stats.update(as_of=as_of, workers=workers, symbols_priced=len(prices),
+                 price_seconds=round(priced_at - started, 3), total_seconds=round(time.perf_counter() - started, 3))
+    return stats
+
+def open_db():
+    """按 STORAGE_BACKEND 选后端；Supabase 要用 service role key 才能读到全部用户"""
+    client = None
+    if os.environ.get("STORAGE_BACKEND", "supabase").lower() != "sqlite":
+        from supabase import create_client
+        url, key = os.environ.get("SUPABASE_URL"), os.environ.get("SUPABASE_KEY")
+        if not url or not key: sys.exit("SUPABASE_URL / SUPABASE_KEY not set (or use STORAGE_BACKEND=sqlite)")
+        client = create_client(url, key)
+    return metrics.instrument_client(storage.open_storage(client))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Evaluate every user against one shared price snapshot")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="process pool size (1 = run in-process)")
+    parser.add_argument("--method", default="FIFO", choices=sorted(price_engine.LOT_METHODS))
+    parser.add_argument("--exchanges", default=os.environ.get("PRICE_EXCHANGES", "kraken"), help="comma-separated, in priority order")
+    parser.add_argument("--dry-run", action="store_true", help="compute but do not write user_snapshots")
+    args = parser.parse_args()
+
+    exchanges = [x.strip() for x in args.exchanges.split(",") if x.strip()]
+    stats = run(open_db(), exchanges, args.workers, args.method, args.dry_run)
+    users_per_s = stats['users'] / max(stats['total_seconds'] - stats['price_seconds'], 1e-9)
+    print(f"{stats['users']} users, {stats['transactions']:,} transactions, {stats['written']} written "
+          f"in {stats['total_seconds']:.1f}s (pricing {stats['price_seconds']:.1f}s, {users_per_s:,.0f} users/s on {stats['workers']} workers)",
+          file=sys.stderr)
+    for user_id, err in stats['failed'][:20]: print(f"  failed {user_id}: {err}", file=sys.stderr)
+    if stats['failed']: sys.exit(1)
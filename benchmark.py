@@ -0,0 +1,355 @@
+"""
+热点路径压测: 合成持仓/账本 + 进程内的假交易所 (ccxt 接口) + 内存 SQLite 存储，不需要网络和 Supabase。
+
+跑一遍:      python benchmark.py --profile quick --out bench.json
+存成基线:    python benchmark.py --profile quick --out bench_baseline.json
+对比基线:    python benchmark.py --profile quick --baseline bench_baseline.json --tolerance 0.25
+只跑某几项:  python benchmark.py --only tax_fifo,dashboard
+
+每项报告 p50/p99/平均耗时、吞吐 (每秒处理的成交或币种数) 和峰值内存 (tracemalloc，单独一轮测，不影响计时)。
+对比基线时 p50 或峰值内存超过基线 (1 + tolerance) 倍算退化，进程退出码为 1。
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import ccxt
+import numpy as np
+import pandas as pd
+
+import price_engine
+from storage import SQLiteStore
+
+PROFILES = {
+    'quick': {'ledger': [1_000, 100_000], 'assets': [10, 500], 'sync_trades': [1_000, 20_000], 'repeats': 5},
+    'full': {'ledger': [1_000, 100_000, 1_000_000, 5_000_000], 'assets': [10, 500, 5_000], 'sync_trades': [1_000, 100_000], 'repeats': 7},
+}
+SYNC_MARKETS = 20
+FAKE_EXCHANGE_ID = 'benchfake'
+# 假交易所每次的市场列表都不一样，不能读写磁盘上的市场缓存
+price_engine.MARKET_CACHE_DIR = None
+
+
+# ==========================================
+# 1. 合成数据
+# ==========================================
+def asset_symbols(n):
+    return [f"C{i:04d}" for i in range(n)]
+
+def synthetic_ledger(n_rows, n_assets=50, seed=7):
+    """n_rows 笔成交，约 60% 买入，时间跨三年；列和数据库里的 transactions 一致"""
+    rng = np.random.default_rng(seed)
+    symbols = np.array(asset_symbols(n_assets))
+    start = np.datetime64('2021-01-01T00:00:00', 's')
+    ts = start + np.sort(rng.integers(0, 3 * 365 * 86400, n_rows)).astype('timedelta64[s]')
+    return pd.DataFrame({
+        'id': np.arange(1, n_rows + 1),
+        'symbol': symbols[rng.integers(0, n_assets, n_rows)],
+        'type': np.where(rng.random(n_rows) < 0.6, 'BUY', 'SELL'),
+        'quantity': rng.lognormal(0, 1, n_rows).round(8),
+        'price': rng.uniform(1, 1000, n_rows).round(2),
+        'timestamp': np.datetime_as_string(ts),
+        'trade_id': np.arange(1, n_rows + 1).astype(str),
+    })
+
+def synthetic_portfolio(n_assets, seed=7):
+    rng = np.random.default_rng(seed)
+    return [{'symbol': s, 'amount': float(a), 'avg_buy_price': float(p)}
+            for s, a, p in zip(asset_symbols(n_assets), rng.uniform(0.01, 100, n_assets), rng.uniform(1, 1000, n_assets))]
+
+
+# ==========================================
+# 2. 假交易所 (ccxt 接口的子集，够 price_engine 用)
+# ==========================================
+def make_fake_exchange(n_assets=50, n_trades=0, n_markets=SYNC_MARKETS, latency=0.0, seed=7):
+    """生成一个 ccxt 风格的交易所类并注册成 ccxt.benchfake，price_engine 按 id 实例化它"""
+    rng = np.random.default_rng(seed)
+    symbols = asset_symbols(n_assets)
+    prices = dict(zip(symbols, rng.uniform(1, 1000, n_assets).tolist()))
+    markets = {f"{s}/USDT": {'symbol': f"{s}/USDT", 'base': s, 'quote': 'USDT'} for s in symbols}
+    markets.update({f"{s}/USD": {'symbol': f"{s}/USD", 'base': s, 'quote': 'USD'} for s in symbols})
+    # 成交平均分到前 n_markets 个 USDT 市场，每个市场按时间递增
+    traded = [f"{s}/USDT" for s in symbols[:n_markets]]
+    trades = {m: [] for m in traded}
+    if n_trades and traded:
+        owner = rng.integers(0, len(traded), n_trades)
+        stamps = 1_600_000_000_000 + np.sort(rng.integers(0, 3 * 365 * 86400_000, n_trades))
+        sides = np.where(rng.random(n_trades) < 0.6, 'buy', 'sell')
+        amounts = rng.lognormal(0, 1, n_trades)
+        for i, (o, t, side, amt) in enumerate(zip(owner.tolist(), stamps.tolist(), sides.tolist(), amounts.tolist())):
+            m = traded[o]
+            trades[m].append({'id': f"{m}-{i}", 'timestamp': t, 'side': side, 'amount': amt, 'price': prices[m.split('/')[0]]})
+    stamps_by_market = {m: np.array([t['timestamp'] for t in ts], np.int64) for m, ts in trades.items()}
+    # 同步成交时余额只含有成交的币种，同步余额时是全部币种
+    balance = {s: 1.0 for s in (symbols[:n_markets] if n_trades else symbols)}
+
+    class FakeExchange:
+        id = FAKE_EXCHANGE_ID
+        rateLimit = 0
+        has = {'fetchTickers': True, 'fetchLedger': False, 'fetchOHLCV': True}
+
+        def __init__(self, config=None):
+            self.enableRateLimit = (config or {}).get('enableRateLimit', True)
+            self.calls = 0
+            self.markets = None
+            self.options = {}
+
+        def _call(self):
+            self.calls += 1
+            if latency: time.sleep(latency)
+
+        def load_markets(self, reload=False):
+            if self.markets is None or reload:
+                self._call()
+                self.markets = markets
+            return self.markets
+
+        def fetch_balance(self):
+            self._call()
+            return {'total': dict(balance)}
+
+        def fetch_tickers(self, pairs=None):
+            self._call()
+            now = time.time() * 1000
+            out = {}
+            for p in pairs or markets:
+                px = prices.get(p.split('/')[0])
+                if px is not None: out[p] = {'last': px, 'bid': px * 0.999, 'ask': px * 1.001, 'timestamp': now}
+            return out
+
+        def fetch_ticker(self, pair):
+            return self.fetch_tickers([pair])[pair]
+
+        def fetch_my_trades(self, market, since=None, limit=None, params=None):
+            self._call()
+            rows, ts = trades.get(market, []), stamps_by_market.get(market)
+            if ts is None or not len(rows): return []
+            first = int(np.searchsorted(ts, since or 0))
+            return rows[first:first + (limit or 500)]
+
+        def parse_timeframe(self, timeframe):
+            return {'1h': 3600, '1d': 86400}[timeframe]
+
+        def milliseconds(self):
+            return int(time.time() * 1000)
+
+        def fetch_ohlcv(self, pair, timeframe, since=None, limit=None):
+            # 价格围着当前报价做确定性的正弦摆动，不同时刻能查出不同的价
+            self._call()
+            step = self.parse_timeframe(timeframe) * 1000
+            base = prices.get(pair.split('/')[0], 1.0)
+            start = since // step * step
+            end = min(start + (limit or 500) * step, self.milliseconds())
+            return [[t, base, base, base, base * (1 + 0.1 * np.sin(t / 86400_000)), 1.0] for t in range(start, end, step)]
+
+    setattr(ccxt, FAKE_EXCHANGE_ID, FakeExchange)
+    # 池里还留着上一个假交易所类的实例 (同一个 id 和密钥)，换了数据要一起清掉
+    price_engine.get_client_pool().clear()
+    return FakeExchange
+
+
+# ==========================================
+# 3. 计时
+# ==========================================
+def measure(fn, setup=None, repeats=5, warmup=1, items=1):
+    """setup 每轮都跑但不计时，返回值传给 fn；最后单独一轮在 tracemalloc 下测峰值内存"""
+    times = []
+    for i in range(warmup + repeats):
+        arg = setup() if setup else None
+        t0 = time.perf_counter()
+        fn(arg)
+        dt = time.perf_counter() - t0
+        if i >= warmup: times.append(dt)
+    arg = setup() if setup else None
+    tracemalloc.start()
+    try:
+        fn(arg)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    times = np.array(times)
+    p50, p99 = np.percentile(times, [50, 99])
+    return {
+        'items': items,
+        'repeats': len(times),
+        'p50_ms': round(float(p50) * 1000, 3),
+        'p99_ms': round(float(p99) * 1000, 3),
+        'mean_ms': round(float(times.mean()) * 1000, 3),
+        'throughput_per_s': round(items / float(p50), 1) if p50 > 0 else None,
+        'peak_mb': round(peak / 2**20, 3),
+    }
+
+def _repeats_for(n, repeats):
+    # 百万级的数据每轮要好几秒，少跑几轮
+    return repeats if n <= 100_000 else max(2, repeats // 3)
+
+
+# ==========================================
+# 4. 压测项
+# ==========================================
+def bench_tax(sizes, repeats, method):
+    calc = price_engine.TaxCalculator(method)
+    for n in sizes:
+        df = synthetic_ledger(n)
+        yield f"tax_{method.lower()}[{n}]", measure(lambda _: calc.calculate(df), repeats=_repeats_for(n, repeats), items=n)
+
+def _market_data(n_assets):
+    make_fake_exchange(n_assets)
+    md = price_engine.MarketData(exchanges=(FAKE_EXCHANGE_ID,), autostart=False)
+    md.update_targets(asset_symbols(n_assets))
+    return md
+
+def bench_dashboard(sizes, repeats):
+    for n in sizes:
+        md = _market_data(n)
+        md._update_cycle()
+        portfolio = synthetic_portfolio(n)
+        yield f"dashboard[{n}]", measure(lambda _: price_engine.calculate_dashboard_data(portfolio, md), repeats=repeats, items=n)
+
+def bench_update_cycle(sizes, repeats):
+    for n in sizes:
+        md = _market_data(n)
+        venue = md.venues[0]
+        def setup():
+            # 每轮都让全部币种到期，测满负荷的一轮
+            md.scheduler.next_due.clear()
+            venue.pending = None
+        yield f"update_cycle[{n}]", measure(lambda _: md._update_cycle(), setup=setup, repeats=repeats, items=n)
+
+def _check(result):
+    ok, msg = result
+    if not ok: raise RuntimeError(msg)
+
+def bench_sync_history(sizes, repeats):
+    for n in sizes:
+        make_fake_exchange(SYNC_MARKETS, n_trades=n)
+        def setup():
+            price_engine.get_query_cache().invalidate('bench')
+            return SQLiteStore(":memory:")
+        run = lambda db: _check(price_engine.sync_history_log(db, 'bench', FAKE_EXCHANGE_ID, 'k', 's'))
+        yield f"sync_history[{n}]", measure(run, setup=setup, repeats=_repeats_for(n, repeats), items=n)
+
+def bench_sync_holdings(sizes, repeats):
+    for n in sizes:
+        make_fake_exchange(n)
+        def setup():
+            price_engine.get_query_cache().invalidate('bench')
+            return SQLiteStore(":memory:")
+        run = lambda db: _check(price_engine.sync_exchange_holdings(db, 'bench', FAKE_EXCHANGE_ID, 'k', 's'))
+        yield f"sync_holdings[{n}]", measure(run, setup=setup, repeats=repeats, items=n)
+
+def bench_price_backfill(sizes, repeats):
+    # 零价兑换记录按历史 K 线补价；第一轮 (预热) 把 K 线拉进本地缓存，计时的是命中缓存的批量查找
+    for n in sizes:
+        make_fake_exchange(50)
+        exchange = getattr(ccxt, FAKE_EXCHANGE_ID)()
+        cache = price_engine.OhlcvCache(tempfile.mkdtemp(prefix="bench_ohlcv_"))
+        rng = np.random.default_rng(7)
+        symbols = asset_symbols(50)
+        stamps = time.time() - rng.uniform(0, 365 * 86400, n)
+        trades = [(symbols[i % 50], datetime.datetime.fromtimestamp(ts)) for i, ts in enumerate(stamps.tolist())]
+        setup = lambda: [{'symbol': s, 'price': 0, 'timestamp': ts} for s, ts in trades]
+        run = lambda rows: price_engine.backfill_prices(exchange, rows, cache)
+        yield f"price_backfill[{n}]", measure(run, setup=setup, repeats=repeats, items=n)
+
+def bench_price_table(sizes, repeats):
+    # 关注列表不断轮换: 每轮换掉一半币种，四轮下来用过的键是报价槽的三倍；顺带核对读进程看到的正好是当前这批，
+    # 关注槽过了 TARGET_IDLE_TTL 能腾给新币种
+    for n in sizes:
+        path = tempfile.mktemp(prefix="bench_prices_", suffix=".bin")
+        writer = price_engine.SharedPriceTable(path, writer=True, slots=n, want_slots=n * 4)
+        reader = price_engine.SharedPriceTable(path)
+        step = max(n // 2, 1)
+        def run(_):
+            for r in range(4):
+                window = asset_symbols(n + 4 * step)[r * step:r * step + n]
+                writer.write({s: (1.0 + r, 'bench', time.time()) for s in window})
+                if set(reader.read()) != set(window): raise RuntimeError(f"price table round {r}: reader does not see the current window")
+                reader.wants['wanted_at'] -= price_engine.TARGET_IDLE_TTL + 1
+                reader.want(window)
+                if not set(window) <= set(reader.wanted(time.time() - 1)): raise RuntimeError(f"price table round {r}: want slots not reused")
+        yield f"price_table[{n}]", measure(run, repeats=repeats, items=4 * n)
+        os.unlink(path)
+
+def bench_cold_import(repeats):
+    # 新进程从启动到 import price_engine 完成的墙钟时间，看冷启动有没有变慢
+    # 在仓库目录里起子进程，从别的目录运行压测时也能 import 到
+    repo = os.path.dirname(os.path.abspath(__file__))
+    run = lambda _: subprocess.run([sys.executable, '-c', 'import price_engine'], cwd=repo, capture_output=True, check=True)
+    yield "cold_import", measure(run, repeats=repeats)
+
+def run_suite(profile, only=None):
+    p = PROFILES[profile]
+    suites = {
+        'tax_fifo': lambda: bench_tax(p['ledger'], p['repeats'], 'FIFO'),
+        'tax_hifo': lambda: bench_tax(p['ledger'][:-1] or p['ledger'], p['repeats'], 'HIFO'),
+        'dashboard': lambda: bench_dashboard(p['assets'], p['repeats']),
+        'update_cycle': lambda: bench_update_cycle(p['assets'], p['repeats']),
+        'sync_history': lambda: bench_sync_history(p['sync_trades'], p['repeats']),
+        'sync_holdings': lambda: bench_sync_holdings(p['assets'], p['repeats']),
+        'price_backfill': lambda: bench_price_backfill(p['sync_trades'], p['repeats']),
+        'price_table': lambda: bench_price_table(p['assets'], p['repeats']),
+        'cold_import': lambda: bench_cold_import(p['repeats']),
+    }
+    results = {}
+    for name, suite in suites.items():
+        if only and name not in only: continue
+        for case, stats in suite():
+            results[case] = stats
+            print(f"{case:<28} p50 {stats['p50_ms']:>10.2f} ms  p99 {stats['p99_ms']:>10.2f} ms  "
+                  f"{stats['throughput_per_s'] or 0:>14,.0f}/s  peak {stats['peak_mb']:>9.2f} MB", file=sys.stderr)
+    return results
+
+
+# ==========================================
+# 5. 基线对比
+# ==========================================
+def environment():
+    try: rev = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True).stdout.strip() or None
+    except Exception: rev = None
+    return {'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+            'platform': platform.platform(), 'git': rev, 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+def compare(results, baseline, tolerance):
+    """返回退化列表: (项目, 指标, 基线值, 当前值)"""
+    regressions = []
+    for case, cur in results.items():
+        base = baseline.get('results', {}).get(case)
+        if not base: continue
+        for metric in ('p50_ms', 'peak_mb'):
+            if base.get(metric) and cur[metric] > base[metric] * (1 + tolerance):
+                regressions.append((case, metric, base[metric], cur[metric]))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark price_engine hot paths against synthetic data")
+    parser.add_argument("--profile", choices=sorted(PROFILES), default="quick")
+    parser.add_argument("--only", default="", help="comma separated suites: tax_fifo,tax_hifo,dashboard,update_cycle,sync_history,sync_holdings,price_backfill,price_table,cold_import")
+    parser.add_argument("--out", help="write results JSON here (default: stdout)")
+    parser.add_argument("--baseline", help="compare against a previously saved results JSON")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args()
+
+    only = {s.strip() for s in args.only.split(",") if s.strip()}
+    report = {'profile': args.profile, 'environment': environment(), 'results': run_suite(args.profile, only)}
+    payload = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w") as f: f.write(payload + "\n")
+    else:
+        print(payload)
+
+    if args.baseline:
+        with open(args.baseline) as f: baseline = json.load(f)
+        regressions = compare(report['results'], baseline, args.tolerance)
+        for case, metric, base, cur in regressions:
+            print(f"REGRESSION {case} {metric}: {base} -> {cur} (+{(cur / base - 1) * 100:.0f}%)", file=sys.stderr)
+        if regressions: sys.exit(1)
+        print(f"no regressions vs {args.baseline} (tolerance {args.tolerance:.0%})", file=sys.stderr)
@@ -0,0 +1,258 @@
+"""
+运行时指标: 计数器、耗时直方图、抓取时回调的 gauge，以及被吞掉的异常 (按位置计数并保留最后一条)。
+
+METRICS=1 打开；不打开时装饰器原样返回函数、lock() 返回普通锁、其余调用第一行就返回，开销可以忽略。
+METRICS_PORT=9108 时另起一个线程提供 Prometheus 文本格式的 /metrics；界面侧边栏也有诊断面板。
+"""
+import contextlib
+import functools
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ENABLED = os.environ.get("METRICS", "").lower() in ("1", "true", "yes", "on")
+PREFIX = "cqos_"
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_lock = threading.Lock()
+_counters = {}     # (name, labels) -> value
+_histograms = {}   # (name, labels) -> [每个桶的计数..., sum, count, max]
+_gauges = {}       # key -> fn() 返回 [(name, labels dict, value)]
+_errors = {}       # site -> [count, 异常类型, 最后一条消息, 时间]
+_local = threading.local()
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+def inc(name, value=1, **labels):
+    if not ENABLED: return
+    k = _key(name, labels)
+    with _lock: _counters[k] = _counters.get(k, 0) + value
+
+def observe(name, seconds, **labels):
+    if not ENABLED: return
+    k = _key(name, labels)
+    with _lock:
+        h = _histograms.get(k)
+        if h is None: h = _histograms[k] = [0] * len(BUCKETS) + [0.0, 0, 0.0]
+        for i, le in enumerate(BUCKETS):
+            if seconds <= le:
+                h[i] += 1
+                break
+        h[-3] += seconds; h[-2] += 1
+        if seconds > h[-1]: h[-1] = seconds
+
+@contextlib.contextmanager
+def _timer(name, labels):
+    t0 = time.perf_counter()
+    try: yield
+    finally: observe(name, time.perf_counter() - t0, **labels)
+
+def timer(name, **labels):
+    """with metrics.timer("x_seconds", venue="kraken"): ...  (关闭时是空的上下文)"""
+    if not ENABLED: return contextlib.nullcontext()
+    return _timer(name, labels)
+
+def timed(name, **labels):
+    """装饰器版 timer；关闭时原样返回被装饰的函数"""
+    def wrap(fn):
+        if not ENABLED: return fn
+        @functools.wraps(fn)
+        def inner(*args, **kwargs):
+            with _timer(name, labels): return fn(*args, **kwargs)
+        return inner
+    return wrap
+
+def error(site, exc):
+    """记录一个被吞掉的异常: 按位置计数，保留最后一条消息"""
+    if not ENABLED: return
+    with _lock:
+        e = _errors.setdefault(site, [0, "", "", 0.0])
+        e[0] += 1; e[1] = type(exc).__name__; e[2] = str(exc)[:300]; e[3] = time.time()
+
+def register_gauges(key, fn):
+    """抓取时才计算的指标 (如每个币种的价格新鲜度)；同一个 key 重复注册会覆盖"""
+    if not ENABLED: return
+    with _lock: _gauges[key] = fn
+
+
+# ==========================================
+# 锁等待/持有时间
+# ==========================================
+class TimedLock:
+    """threading.Lock 的替身，额外记录拿锁等了多久、拿着锁多久"""
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self._held_at = 0.0
+
+    def acquire(self, blocking=True, timeout=-1):
+        t0 = time.perf_counter()
+        ok = self._lock.acquire(blocking, timeout)
+        if ok:
+            self._held_at = time.perf_counter()
+            observe("lock_wait_seconds", self._held_at - t0, lock=self.name)
+        return ok
+
+    def release(self):
+        held = time.perf_counter() - self._held_at
+        self._lock.release()
+        observe("lock_hold_seconds", held, lock=self.name)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+def lock(name):
+    return TimedLock(name) if ENABLED else threading.Lock()
+
+
+# ==========================================
+# 数据库调用: 包一层客户端，按表和操作计时，并按当前线程的 rerun 计数
+# ==========================================
+_QUERY_OPS = ('select', 'insert', 'upsert', 'update', 'delete')
+
+class _QueryProxy:
+    def __init__(self, query, table):
+        self._query = query
+        self._table = table
+        self._op = 'select'
+
+    def __getattr__(self, name):
+        attr = getattr(self._query, name)
+        if not callable(attr): return attr
+        if name == 'execute': return self._execute
+        def chain(*args, **kwargs):
+            if name in _QUERY_OPS: self._op = name
+            self._query = attr(*args, **kwargs)
+            return self
+        return chain
+
+    def _execute(self):
+        _local.db_calls = getattr(_local, 'db_calls', 0) + 1
+        t0 = time.perf_counter()
+        try:
+            return self._query.execute()
+        except Exception:
+            inc("db_errors_total", table=self._table, op=self._op)
+            raise
+        finally:
+            observe("db_call_seconds", time.perf_counter() - t0, table=self._table, op=self._op)
+
+class _ClientProxy:
+    def __init__(self, client):
+        self._client = client
+
+    def table(self, name):
+        return _QueryProxy(self._client.table(name), name)
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+def instrument_client(client):
+    """Supabase 客户端或 SQLiteStore 都能包；关闭时原样返回"""
+    if not ENABLED or client is None: return client
+    return _ClientProxy(client)
+
+
+class rerun_scope(contextlib.ContextDecorator):
+    """一次 Streamlit 重跑 (或一个 fragment) 的耗时和其间的数据库调用次数；可以嵌套，内层的调用也算进外层"""
+    def __init__(self, scope):
+        self.scope = scope
+
+    def __enter__(self):
+        if not ENABLED: return self
+        self._outer = getattr(_local, 'db_calls', 0)
+        _local.db_calls = 0
+        self._t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if not ENABLED: return False
+        calls = _local.db_calls
+        _local.db_calls = self._outer + calls
+        observe("rerun_seconds", time.perf_counter() - self._t0, scope=self.scope)
+        inc("rerun_db_calls_total", calls, scope=self.scope)
+        inc("reruns_total", scope=self.scope)
+        return False
+
+
+# ==========================================
+# 输出: Prometheus 文本格式 / 面板用的表格
+# ==========================================
+def _escape(v):
+    return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+
+def _labels(labels):
+    if not labels: return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}"
+
+def _collect_gauges():
+    out = []
+    for key, fn in list(_gauges.items()):
+        try: out.extend((name, _key(name, labels)[1], value) for name, labels, value in fn())
+        except Exception as e: error(f"gauge:{key}", e)
+    return out
+
+def render():
+    """Prometheus 文本格式"""
+    gauges = _collect_gauges()
+    with _lock:
+        counters = sorted(_counters.items())
+        histograms = sorted((k, list(v)) for k, v in _histograms.items())
+        errors = sorted((site, list(e)) for site, e in _errors.items())
+    lines = []
+    for (name, labels), value in counters:
+        lines.append(f"{PREFIX}{name}{_labels(labels)} {value}")
+    for (name, labels), h in histograms:
+        cum = 0
+        for le, n in zip(BUCKETS, h):
+            cum += n
+            lines.append(f"{PREFIX}{name}_bucket{_labels(labels + (('le', le),))} {cum}")
+        lines.append(f"{PREFIX}{name}_bucket{_labels(labels + (('le', '+Inf'),))} {h[-2]}")
+        lines.append(f"{PREFIX}{name}_sum{_labels(labels)} {h[-3]}")
+        lines.append(f"{PREFIX}{name}_count{_labels(labels)} {h[-2]}")
+    for name, labels, value in gauges:
+        lines.append(f"{PREFIX}{name}{_labels(labels)} {value}")
+    for site, (count, kind, _, _) in errors:
+        lines.append(f'{PREFIX}swallowed_errors_total{{site="{site}",type="{kind}"}} {count}')
+    return "\n".join(lines) + "\n"
+
+def summary():
+    """诊断面板用: (耗时表, 计数表, 异常表)，每张表是 dict 列表"""
+    gauges = _collect_gauges()
+    with _lock:
+        timings = [{'metric': name, 'labels': _labels(labels), 'count': h[-2],
+                    'avg_ms': h[-3] / h[-2] * 1000 if h[-2] else 0.0, 'max_ms': h[-1] * 1000}
+                   for (name, labels), h in sorted(_histograms.items())]
+        counts = [{'metric': name, 'labels': _labels(labels), 'value': v} for (name, labels), v in sorted(_counters.items())]
+        errors = [{'site': site, 'count': e[0], 'type': e[1], 'last': e[2],
+                   'at': time.strftime('%H:%M:%S', time.localtime(e[3]))} for site, e in sorted(_errors.items())]
+    counts += [{'metric': name, 'labels': _labels(labels), 'value': v} for name, labels, v in gauges]
+    return timings, counts, errors
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404); return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def serve(port, host="0.0.0.0"):
+    """在后台线程提供 /metrics (调用方保证每个进程只调一次)"""
+    server = ThreadingHTTPServer((host, port), _Handler)
+    threading.Thread(target=server.serve_forever, daemon=True, name="metrics-http").start()
+    return server
@@ -1,39 +1,603 @@
 import time
 import threading
-import ccxt
+import asyncio
+import json
+import io
+import os
+import random
+import tempfile
+import zlib
+import hashlib
+import importlib
+import contextlib
 import pandas as pd
 import streamlit as st
 import datetime
-from collections import deque
-from streamlit_autorefresh import st_autorefresh
+import heapq
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from types import MappingProxyType
+from typing import Mapping, NamedTuple
+import numpy as np
+import metrics
 
-# ==========================================
-# 0. 页面配置 & 自动刷新 (核心配置)
-# ==========================================
-st.set_page_config(
-    page_title="Crypto Dashboard",
-    page_icon="💰",
-    layout="wide",
-    initial_sidebar_state="expanded"
-)
+class _LazyModule:
+    """第一次访问属性时才 import (ccxt 光导入就要零点几秒，只读共享价格表的进程根本用不到)"""
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None: self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
 
-# 设置每 2000 毫秒 (2秒) 自动刷新一次页面
-# 配合后台的 2秒抓取，实现准实时跳动
-st_autorefresh(interval=2000, key="data_refresher")
+ccxt = _LazyModule("ccxt")
 
 # ==========================================
 # 1. 实时价格获取 (智能防崩溃 + 极速版)
 # ==========================================
+KRAKEN_WS_URL = "wss://ws.kraken.com/v2"
+STREAM_STALE_SEC = 5      # 推送流超过这么久没有任何消息 (含心跳) 就视为断线，回退到轮询
+PUBLISH_INTERVAL = 0.25   # 推送流每条消息都会改报价，快照最多这么久重建一次
+MARKET_INDEX_TTL = 3600   # 市场列表刷新周期 (秒)
+MARKET_INDEX_RETRY = 30   # 市场列表加载失败后多久重试
+NEGATIVE_CACHE_TTL = 600  # 解析不到交易对的币种多久之后再试
+QUOTE_PREFERENCE = ('USD', 'ZUSD', 'USDT', 'USDC')
+# 市场索引还没加载成功时按各交易所自己的习惯拼交易对 (没列出的按美元)
+VENUE_DEFAULT_QUOTE = {'binance': 'USDT', 'bybit': 'USDT', 'okx': 'USDT', 'kucoin': 'USDT', 'gateio': 'USDT', 'mexc': 'USDT', 'htx': 'USDT'}
+USD_QUOTES = ['USD', 'USDT', 'USDC', 'DAI', 'ZUSD']
+VENUE_TIMEOUT = 1.5       # 每轮最多等各交易所这么久，慢的交易所结果到了再单独写入
+QUOTE_MAX_AGE = 30        # 报价超过这么久就不算新鲜，让位给低优先级但更新的交易所
+BREAKER_THRESHOLD = 3     # 连续失败几次熔断
+BREAKER_COOLDOWN = 30     # 熔断冷却时间 (秒)，连续熔断则翻倍，最多 BREAKER_MAX_COOLDOWN
+BREAKER_MAX_COOLDOWN = 300
+STREAM_SOURCE = "kraken-ws"
+BRIDGE_QUOTES = ('BTC', 'ETH')   # 没有美元交易对时退而求其次的计价币，由换算图折算成美元
+CROSS_MAX_HOPS = 3        # 换算路径最多几跳
+CROSS_HOP_COST = 0.001    # 每多换算一次的固定代价，再加上该交易对的相对点差
+MARKET_CACHE_DIR = os.environ.get("MARKET_CACHE_DIR") or os.path.join(tempfile.gettempdir(), "crypto_quant_markets")  # None 关掉磁盘缓存
+MARKET_CACHE_TTL = 86400  # 磁盘上的市场列表多久算过期 (秒)
+
+def derive_usd_prices(pair_prices, pair_spreads=None, pair_times=None, max_hops=CROSS_MAX_HOPS):
+    """在一份报价快照上建换算图，一次向量化松弛求出每个币种到 USD 的最便宜路径。
+    pair_prices: {'X/BTC': 价格}；稳定币一律视为 USD。返回 {币种: (美元价格, 路径, 最旧一腿的时间)}"""
+    pair_spreads = pair_spreads or {}
+    pair_times = pair_times or {}
+    edges = []
+    for pair, price in pair_prices.items():
+        base, quote = pair.split('/')[:2]
+        base = 'USD' if base in USD_QUOTES else base
+        quote = 'USD' if quote in USD_QUOTES else quote
+        if base == quote or not price or price <= 0: continue
+        edges.append((base, quote, float(price), CROSS_HOP_COST + pair_spreads.get(pair, 0.0), pair_times.get(pair, 0.0)))
+    assets = sorted({e[0] for e in edges} | {e[1] for e in edges} | {'USD'})
+    idx = {a: i for i, a in enumerate(assets)}
+    n = len(assets)
+    rate = np.ones((n, n)); cost = np.full((n, n), np.inf); edge_ts = np.zeros((n, n))
+    for base, quote, price, c, ts in edges:
+        i, j = idx[base], idx[quote]
+        if c < cost[i, j]:
+            rate[i, j], rate[j, i] = price, 1 / price
+            cost[i, j] = cost[j, i] = c
+            edge_ts[i, j] = edge_ts[j, i] = ts
+
+    usd = idx['USD']
+    dist = np.full(n, np.inf); dist[usd] = 0.0
+    usd_px = np.full(n, np.nan); usd_px[usd] = 1.0
+    nxt = np.full(n, -1)
+    rows = np.arange(n)
+    for _ in range(max_hops):
+        # i 经由 j 到 USD 的代价 = cost[i, j] + dist[j]
+        cand = cost + dist[None, :]
+        j = np.argmin(cand, axis=1)
+        best = cand[rows, j]
+        better = best < dist
+        if not better.any(): break
+        usd_px[better] = rate[better, j[better]] * usd_px[j[better]]
+        dist[better] = best[better]
+        nxt[better] = j[better]
+
+    derived = {}
+    for i in np.flatnonzero(np.isfinite(dist)):
+        if i == usd: continue
+        path, oldest, k = [assets[i]], np.inf, i
+        while k != usd and len(path) <= max_hops:
+            oldest = min(oldest, edge_ts[k, nxt[k]]); k = nxt[k]; path.append(assets[k])
+        derived[assets[i]] = (float(usd_px[i]), path, float(oldest))
+    return derived
+
+STABLE_COINS = ['USDC', 'USDT', 'DAI', 'BUSD', 'FDUSD']
+
+class PriceSnapshot(NamedTuple):
+    """写线程发布的不可变价格快照；读者拿到引用后随便读，不需要加锁"""
+    version: int
+    prices: Mapping
+    quotes: Mapping
+    published_at: float
+
+    def lookup(self, symbol):
+        s = symbol.upper().strip()
+        for k in (s, f"{s}/USD", f"{s}/USDT"):
+            if k in self.prices: return self.prices[k]
+        # 稳定币兜底
+        if s in STABLE_COINS: return 1.0
+        return 0.0
+
+EMPTY_SNAPSHOT = PriceSnapshot(0, MappingProxyType({}), MappingProxyType({}), 0.0)
+
+HISTORY_SECONDS = 86400   # 每个币种保留多久的价格历史
+HISTORY_RESOLUTION = 30   # 历史采样间隔 (秒)，同一间隔内只记第一笔
+
+class PriceRing:
+    """单个币种的定长环形缓冲: 两列预分配的 float64 (时间, 价格)，追加 O(1)，内存固定"""
+    def __init__(self, capacity=HISTORY_SECONDS // HISTORY_RESOLUTION + 1, resolution=HISTORY_RESOLUTION):
+        self.ts = np.zeros(capacity)
+        self.px = np.zeros(capacity)
+        self.resolution = resolution
+        self.head = 0   # 下一个写入位置
+        self.size = 0
+
+    def append(self, ts, price):
+        # head - 1 为 -1 时正好绕回数组末尾
+        if self.size and ts - self.ts[self.head - 1] < self.resolution: return
+        self.ts[self.head] = ts
+        self.px[self.head] = price
+        self.head = (self.head + 1) % len(self.ts)
+        self.size = min(self.size + 1, len(self.ts))
+
+    def arrays(self, since=None):
+        """按时间顺序返回 (时间, 价格) 的副本，可选只取 since 之后的"""
+        if self.size < len(self.ts):
+            ts, px = self.ts[:self.size].copy(), self.px[:self.size].copy()
+        else:
+            ts = np.concatenate((self.ts[self.head:], self.ts[:self.head]))
+            px = np.concatenate((self.px[self.head:], self.px[:self.head]))
+        if since is not None:
+            i = np.searchsorted(ts, since)
+            ts, px = ts[i:], px[i:]
+        return ts, px
+
+def price_at(ts, px, when):
+    """when 时刻 (或之前最近一笔) 的价格；比最早记录还早就返回最早那笔。返回 (价格, 时间)"""
+    if not len(ts): return None
+    i = max(np.searchsorted(ts, when, side='right') - 1, 0)
+    return float(px[i]), float(ts[i])
+
+def downsample_ohlc(ts, px, bucket_seconds):
+    """按 bucket_seconds 分桶的 OHLC，索引是桶的起始时间 (UTC)"""
+    if not len(ts): return pd.DataFrame(columns=['open', 'high', 'low', 'close'])
+    buckets = (ts // bucket_seconds).astype(np.int64)
+    starts = np.flatnonzero(np.diff(buckets, prepend=buckets[0] - 1))
+    ends = np.append(starts[1:], len(px)) - 1
+    return pd.DataFrame({
+        'open': px[starts],
+        'high': np.maximum.reduceat(px, starts),
+        'low': np.minimum.reduceat(px, starts),
+        'close': px[ends],
+    }, index=pd.to_datetime(buckets[starts] * bucket_seconds, unit='s', utc=True))
+
+def _market_cache_path(exchange_id):
+    return os.path.join(MARKET_CACHE_DIR, f"{exchange_id}.json")
+
+def load_markets_cached(exchange, reload=False):
+    """exchange.load_markets() 加一层磁盘缓存: 重启后 MARKET_CACHE_TTL 内直接用上次的市场列表，不再整表下载。
+    reload=True 强制找交易所要，并顺手写回磁盘"""
+    if not reload and exchange.markets: return exchange.markets
+    # 有的交易所把解析辅助表放在 options 里 (如 Kraken 的 marketsByAltname)，随市场列表一起存取
+    helpers = exchange.options.get('marketHelperProps', []) if isinstance(exchange.options, dict) else []
+    path = _market_cache_path(exchange.id) if MARKET_CACHE_DIR else None
+    if not reload and path:
+        try:
+            if time.time() - os.path.getmtime(path) < MARKET_CACHE_TTL:
+                with open(path) as f: cached = json.load(f)
+                exchange.set_markets(cached['markets'], cached.get('currencies'))
+                for k, v in cached.get('options', {}).items(): exchange.options[k] = v
+                metrics.inc("market_cache_total", venue=exchange.id, result="hit")
+                return exchange.markets
+        except FileNotFoundError: pass
+        except Exception as e: metrics.error(f"market_cache:{exchange.id}", e)
+    metrics.inc("market_cache_total", venue=exchange.id, result="miss")
+    markets = exchange.load_markets(reload=True)
+    if path:
+        # 先写临时文件再改名，别的进程读不到写了一半的文件
+        try:
+            os.makedirs(MARKET_CACHE_DIR, exist_ok=True)
+            payload = {'markets': markets, 'currencies': exchange.currencies,
+                       'options': {k: exchange.options[k] for k in helpers if k in exchange.options}}
+            fd, tmp = tempfile.mkstemp(dir=MARKET_CACHE_DIR, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "w") as f: json.dump(payload, f, default=str)
+                os.replace(tmp, path)
+            except BaseException:
+                os.unlink(tmp)
+                raise
+        except Exception as e: metrics.error(f"market_cache:{exchange.id}", e)
+    return markets
+
+class ExchangeVenue:
+    """单个交易所: 客户端 + 市场索引 + 熔断器"""
+    def __init__(self, exchange_id):
+        self.id = exchange_id
+        self._exchange = None
+        self.lock = threading.Lock()
+        # 市场索引: base -> {quote: 交易对}，以及解析结果和解析不了的负缓存
+        self.market_index = None
+        self.listed = set()
+        self.index_loaded_at = 0.0
+        self.resolved = {}
+        self.unresolved = {}
+        # 熔断器状态
+        self.failures = 0
+        self.cooldown = BREAKER_COOLDOWN
+        self.open_until = 0.0
+        self.pending = None
+
+    @property
+    def exchange(self):
+        # 用到才建客户端 (连带导入 ccxt)
+        if self._exchange is None:
+            self._exchange = getattr(ccxt, self.id)({'enableRateLimit': True, 'timeout': 10000})
+        return self._exchange
+
+    def available(self):
+        # 上一轮请求还没回来 (慢交易所) 就不再叠加新请求
+        idle = self.pending is None or self.pending.done()
+        return idle and time.time() >= self.open_until
+
+    def record_success(self):
+        self.failures = 0
+        self.cooldown = BREAKER_COOLDOWN
+
+    def record_failure(self):
+        """每次失败都指数退避，连续失败 BREAKER_THRESHOLD 次熔断；都加随机抖动，避免多个进程同时重试"""
+        self.failures += 1
+        if self.failures >= BREAKER_THRESHOLD:
+            delay = self.cooldown
+            self.cooldown = min(self.cooldown * 2, BREAKER_MAX_COOLDOWN)
+            self.failures = 0
+        else:
+            delay = POLL_RETRY_BASE * 2 ** (self.failures - 1)
+        self.open_until = time.time() + delay * random.uniform(0.5, 1.0)
+
+    def refresh_market_index(self, reload=True):
+        """从交易所市场列表重建索引，顺便清空解析缓存；reload=False 时允许用磁盘上的缓存"""
+        markets = load_markets_cached(self.exchange, reload)
+        index = {}
+        for m in markets.values():
+            if m.get('active') is False or not m.get('spot', True): continue
+            index.setdefault(m['base'], {})[m['quote']] = m['symbol']
+        with self.lock:
+            self.market_index = index
+            self.listed = set(markets)
+            self.resolved.clear(); self.unresolved.clear()
+        self.index_loaded_at = time.time()
+
+    def ensure_market_index(self):
+        if time.time() - self.index_loaded_at < MARKET_INDEX_TTL: return
+        # 进程刚起来的第一次可以用磁盘缓存，之后的定期刷新一律找交易所要
+        try: self.refresh_market_index(reload=self.market_index is not None)
+        except Exception as e:
+            metrics.error(f"market_index:{self.id}", e)
+            self.index_loaded_at = time.time() - MARKET_INDEX_TTL + MARKET_INDEX_RETRY
+            self.record_failure() # 交易所连市场列表都拿不到，和抓价失败一样累计到熔断器
+
+    def _resolve(self, symbol):
+        """目标币种 -> 交易所上最合适的计价交易对；上不了的返回 None (调用方持锁)"""
+        s = symbol.strip().upper()
+        if s in self.resolved: return self.resolved[s]
+        if self.unresolved.get(s, 0) > time.time(): return None
+        if '/' in s:
+            pair = s if s in self.listed else None
+        else:
+            quotes = self.market_index.get(s, {})
+            pair = next((quotes[q] for q in QUOTE_PREFERENCE + BRIDGE_QUOTES if q in quotes), None)
+        if pair: self.resolved[s] = pair
+        else: self.unresolved[s] = time.time() + NEGATIVE_CACHE_TTL
+        return pair
+
+    def pair_list(self, targets):
+        with self.lock:
+            if self.market_index is not None:
+                pairs = {p for p in map(self._resolve, targets) if p}
+                # 只有 BTC/ETH 计价的币，要把桥接币自己的美元价一起抓回来才能换算
+                bridges = {p.split('/')[1] for p in pairs} & set(BRIDGE_QUOTES)
+                pairs |= {p for p in map(self._resolve, bridges) if p}
+                return sorted(pairs)
+        # 索引还没加载成功: 按这个交易所常用的计价币直接拼
+        metrics.inc("price_index_fallback_total", venue=self.id)
+        quote = VENUE_DEFAULT_QUOTE.get(self.id, 'USD')
+        fetch_list = []
+        for symbol in targets:
+            s = symbol.strip().upper()
+            if '/' not in s:
+                fetch_list.append(f"{s}/{quote}")
+            else:
+                fetch_list.append(s)
+        return fetch_list
+
+    def fetch(self, targets):
+        self.ensure_market_index()
+        # 只抓持仓币解析出来的交易对；交易所没上的币已经在负缓存里，不会让整批请求报错
+        fetch_list = self.pair_list(targets)
+        if not fetch_list: return {}
+        if self.exchange.has.get('fetchTickers'):
+            return self.exchange.fetch_tickers(fetch_list)
+        # 交易所没有批量接口，只能逐个抓
+        metrics.inc("price_per_symbol_fetch_total", venue=self.id)
+        return {s: self.exchange.fetch_ticker(s) for s in fetch_list}
+
+PRICE_TABLE_SLOTS = 4096     # 共享价格表最多容纳多少个报价键 (淘汰的键腾出槽位，满了挤掉最久没更新的)
+PRICE_TABLE_WANT_SLOTS = 1024  # 读进程登记关注币种的槽位数 (按 crc32 散列，线性探测，过了 TARGET_IDLE_TTL 的槽位可以复用)
+PRICE_TABLE_WANT_PROBES = 8
+PRICE_TABLE_POLL = 0.5       # 读进程多久检查一次表的版本号
+PRICE_TABLE_STALE = 10       # 写进程心跳超过这么久没更新，auto 模式下的读进程尝试接管
+PRICE_TABLE_MAGIC = 0x43514F5350524943
+PRICE_TABLE_HEADER = np.dtype([('magic', '<u8'), ('slots', '<u4'), ('want_slots', '<u4'), ('count', '<u4'), ('pad', '<u4'),
+                               ('seq', '<u8'), ('heartbeat', '<f8'), ('pid', '<u8')])
+PRICE_TABLE_RECORD = np.dtype([('seq', '<u8'), ('price', '<f8'), ('ts', '<f8'), ('key', 'S24'), ('source', 'S40')])
+PRICE_TABLE_WANT = np.dtype([('key', 'S24'), ('wanted_at', '<f8')])
+
+def default_price_table_path():
+    base = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(base, 'crypto_quant_prices.bin')
+
+class SharedPriceTable:
+    """单写多读的定长价格表，放在 mmap 文件里 (默认 /dev/shm，即内存)，所有 Streamlit 进程共享一份行情。
+    布局: 表头 | 报价槽 (键/价格/时间/来源/槽位序号) | 关注槽 (读进程登记想要的币种)。
+    每个槽位是一个 seqlock: 写之前序号变奇数，写完变偶数；读者前后序号一致且为偶数才算读到完整的一条。
+    键为空的报价槽是墓碑 (被淘汰的币种)，读者跳过，写进程留给下一个新键。
+    读者直接拿 numpy 视图读 mmap，不经过任何序列化"""
+    def __init__(self, path, writer=False, slots=PRICE_TABLE_SLOTS, want_slots=PRICE_TABLE_WANT_SLOTS):
+        self.path = path
+        self.writer = writer
+        header = None
+        if os.path.exists(path) and os.path.getsize(path) >= PRICE_TABLE_HEADER.itemsize:
+            header = np.memmap(path, dtype=PRICE_TABLE_HEADER, mode='r', shape=(1,))[0].copy()
+            if header['magic'] != PRICE_TABLE_MAGIC: header = None
+        if header is None:
+            if not writer: raise FileNotFoundError(path)
+            self._map(np.memmap(path, dtype=self._layout(slots, want_slots), mode='w+', shape=()))
+            self.header['magic'], self.header['slots'], self.header['want_slots'] = PRICE_TABLE_MAGIC, slots, want_slots
+        else:
+            # 已有的表 (写进程重启或被接管) 沿用原布局和内容，序号继续往上加
+            self._map(np.memmap(path, dtype=self._layout(int(header['slots']), int(header['want_slots'])), mode='r+', shape=()))
+        keys = self.records['key'][:int(self.header['count'])].tolist()
+        self.index = {k.decode(): i for i, k in enumerate(keys) if k}
+        self.free = [i for i, k in enumerate(keys) if not k]
+        self.written = {}
+        if writer: self.header['pid'] = os.getpid()
+
+    @staticmethod
+    def _layout(slots, want_slots):
+        return np.dtype([('header', PRICE_TABLE_HEADER), ('records', PRICE_TABLE_RECORD, (slots,)), ('wants', PRICE_TABLE_WANT, (want_slots,))])
+
+    def _map(self, mm):
+        self.mm = mm
+        self.header = mm['header']
+        self.records = mm['records']
+        self.wants = mm['wants']
+
+    # --- 写进程 ---
+    def write(self, quotes):
+        """只写和上次不同的报价；本进程写过、现在不在 quotes 里的 (被淘汰的) 键写成墓碑，槽位留给新键。
+        新键追加到末尾时 count 最后才加，读者不会看到写了一半的键"""
+        changed = [(k, q) for k, q in quotes.items() if self.written.get(k) != q]
+        gone = [k for k in self.written if k not in quotes]
+        if not changed and not gone: return
+        rec = self.records
+        for key in gone:
+            i = self.index.pop(key)
+            del self.written[key]
+            rec['seq'][i] += 1
+            rec['key'][i] = b''
+            rec['seq'][i] += 1
+            self.free.append(i)
+        for key, (price, source, ts) in changed:
+            if len(key.encode()) > 24: continue # 键太长: 只在本进程可见
+            i = self.index.get(key)
+            new = i is None
+            if new: i = self._claim()
+            rec['seq'][i] += 1
+            if new: rec['key'][i] = key.encode()
+            rec['price'][i] = price
+            rec['ts'][i] = ts
+            rec['source'][i] = source.encode()[:40]
+            rec['seq'][i] += 1
+            if new:
+                self.index[key] = i
+                if i >= int(self.header['count']): self.header['count'] = i + 1
+            self.written[key] = (price, source, ts)
+        self.header['seq'] += 1
+
+    def _claim(self):
+        """给新键找槽位: 墓碑 > 末尾 > 挤掉最久没更新的一条 (可能是上一个写进程留下的)"""
+        if self.free: return self.free.pop()
+        n = int(self.header['count'])
+        if n < len(self.records): return n
+        i = int(np.argmin(self.records['ts']))
+        victim = self.records['key'][i].decode()
+        self.index.pop(victim, None)
+        self.written.pop(victim, None)
+        metrics.inc("price_table_evictions_total")
+        return i
+
+    def beat(self):
+        self.header['heartbeat'] = time.time()
+
+    def wanted(self, since=0.0):
+        """读进程登记过的币种 (since 之后还被要过的): {币种: 最后登记时间}"""
+        w = self.wants
+        mask = (w['key'] != b'') & (w['wanted_at'] >= since)
+        return {k.decode(): at for k, at in zip(w['key'][mask].tolist(), w['wanted_at'][mask].tolist())}
+
+    # --- 读进程 ---
+    @property
+    def seq(self):
+        return int(self.header['seq'])
+
+    @property
+    def heartbeat(self):
+        return float(self.header['heartbeat'])
+
+    def read(self, retries=3):
+        """一致地读出所有报价: {key: (price, source, ts)}；读到正在写的槽位就重试，重试不过的本次跳过"""
+        n = int(self.header['count'])
+        rec = self.records[:n]
+        out = {}
+        todo = np.arange(n)
+        for _ in range(retries):
+            before = rec['seq'][todo].copy()
+            data = rec[todo].copy()
+            after = rec['seq'][todo]
+            ok = (before == after) & (before % 2 == 0) & (before > 0)
+            for key, price, ts, source in zip(data['key'][ok].tolist(), data['price'][ok].tolist(), data['ts'][ok].tolist(), data['source'][ok].tolist()):
+                if key: out[key.decode()] = (price, source.decode(), ts)
+            todo = todo[~ok & (before > 0)]
+            if not len(todo): break
+        return out
+
+    def want(self, symbols):
+        """读进程登记关注的币种: 探测范围里已有这个键就刷新时间，否则占第一个空槽或过了 TARGET_IDLE_TTL 没人要的槽。
+        多个读进程抢同一个槽时可能丢一条，下次 update_targets 会补上"""
+        w = self.wants
+        now = time.time()
+        for symbol in symbols:
+            key = symbol.encode()
+            if len(key) > 24: continue
+            start = zlib.crc32(key) % len(w)
+            probes = [(start + p) % len(w) for p in range(PRICE_TABLE_WANT_PROBES)]
+            i = next((i for i in probes if w['key'][i] == key), None)
+            if i is None: i = next((i for i in probes if w['key'][i] == b'' or w['wanted_at'][i] < now - TARGET_IDLE_TTL), None)
+            if i is None: continue
+            w['key'][i] = key
+            w['wanted_at'][i] = now
+
+    def flush(self):
+        if self.writer: self.mm.flush()
+
+def try_lock_publisher(path):
+    """auto 模式选主: 谁拿到 path.lock 的排他锁谁当写进程，锁随进程退出自动释放"""
+    try:
+        import fcntl
+        fd = os.open(path + '.lock', os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return None
+        return fd
+    except ImportError:
+        return None # 没有 flock 的平台只能显式指定角色
+
+TARGET_IDLE_TTL = 900     # 币种多久没人请求就移出关注列表，历史一并丢掉
+PINNED_TARGETS = ('BTC', 'ETH', 'SOL', 'USDT')   # 默认关注列表，防止启动时空跑，也不会被淘汰
+POLL_HOT = 2              # 最近 POLL_HOT_WINDOW 秒内有人看的币种的刷新间隔
+POLL_HOT_WINDOW = 60
+POLL_IDLE = 20            # 还在关注期内但最近没人看的币种
+POLL_VOL_WINDOW = 300     # 用最近多久的振幅衡量波动
+POLL_CALM_MOVE = 0.002    # 振幅低于这个比例算平静，间隔放宽一倍
+POLL_VOLATILE_MOVE = 0.01 # 振幅超过这个比例，不管热度都按 POLL_HOT 刷新
+POLL_MIN_SLEEP = 0.5
+POLL_RETRY_BASE = 1       # 出错后的首次退避 (秒)，之后指数翻倍并加随机抖动
+
+class PollScheduler:
+    """按需抓价: 记录每个币种最后被请求的时间，按热度和波动给出刷新间隔，每轮只返回到期的币种"""
+    def __init__(self, pinned=PINNED_TARGETS):
+        self.pinned = set(pinned)
+        self.demand = {}
+        self.next_due = {}
+
+    def touch(self, symbols, when=None):
+        now = when or time.time()
+        for s in symbols:
+            if self.demand.get(s, 0) < now: self.demand[s] = now
+
+    def idle(self, targets, now):
+        """超过 TARGET_IDLE_TTL 没人请求的币种 (固定关注的除外)"""
+        return [s for s in targets if s not in self.pinned and now - self.demand.get(s, 0) > TARGET_IDLE_TTL]
+
+    def forget(self, symbols):
+        for s in symbols:
+            self.demand.pop(s, None); self.next_due.pop(s, None)
+
+    def interval(self, symbol, now, move=None):
+        if move is not None and move >= POLL_VOLATILE_MOVE: return POLL_HOT
+        base = POLL_HOT if now - self.demand.get(symbol, 0) < POLL_HOT_WINDOW else POLL_IDLE
+        if move is not None and move < POLL_CALM_MOVE: base *= 2
+        return base
+
+    def due(self, targets, now):
+        return [s for s in targets if self.next_due.get(s, 0) <= now]
+
+    def schedule(self, symbols, now, moves):
+        for s in symbols:
+            self.next_due[s] = now + self.interval(s, now, moves.get(s))
+
+    def sleep_for(self, targets, now):
+        """睡到下一个币种到期；最多睡 POLL_HOT，新加入的币种不用等太久"""
+        nxt = min((self.next_due.get(s, 0) for s in targets), default=now + POLL_HOT)
+        return min(max(nxt - now, POLL_MIN_SLEEP), POLL_HOT)
+
 class MarketData:
-    def __init__(self):
+    def __init__(self, feed="poll", stream_url=KRAKEN_WS_URL, exchanges=('kraken',), role="standalone", table_path=None, autostart=True):
+        # prices/quotes 是写线程的工作副本 (持锁修改)，读者只读 self.snapshot
         self.prices = {}
-        # 默认关注列表，防止启动时空跑
-        self.targets = {'BTC', 'ETH', 'SOL', 'USDT'} 
-        self.lock = threading.Lock()
-        self.exchange = ccxt.kraken()
+        self.snapshot = EMPTY_SNAPSHOT
+        self.dirty = False  # 工作副本有还没发布进快照的改动
+        # 每个价格的来源和时间: key -> (price, source, ts)；venue_quotes 保留各交易所各自的最新报价
+        self.quotes = {}
+        self.venue_quotes = {}
+        self.spreads = {}
+        # 每个关注币种的价格历史
+        self.history = {}
+        # 关注列表: 按请求时间淘汰，按热度和波动安排刷新
+        self.targets = set(PINNED_TARGETS)
+        self.scheduler = PollScheduler()
+        self.lock = metrics.lock("market_data")
+        # exchanges 的顺序就是优先级，推送流的优先级最高
+        self.venues = [ExchangeVenue(x) for x in exchanges]
+        self.priority = {v.id: i for i, v in enumerate(self.venues)}
+        self.priority[STREAM_SOURCE] = -1
+        # 推送流说的是 Kraken 协议，订阅的交易对按 Kraken 的索引解析；没配 Kraken 轮询时单独建一个只管索引的
+        self.stream_venue = next((v for v in self.venues if v.id == 'kraken'), None) or ExchangeVenue('kraken')
+        self.pool = ThreadPoolExecutor(max_workers=len(self.venues), thread_name_prefix="venue")
         self.running = True
+        # feed="stream" 时优先走 WebSocket 推送，断流期间由轮询线程兜底
+        self.feed = feed
+        self.stream_url = stream_url
+        self.stream_last_msg = 0.0
+        self.stream_seen = {}  # 交易对 -> 推送流最后一次推来报价的时间；心跳只说明连接还在
+        self.stream_stats = {'messages': 0, 'updates': 0, 'reconnects': 0, 'latency_ms': None}
+        metrics.register_gauges("market_data", self._gauges)
+        # role: standalone 自己抓价；publisher 抓价并写共享价格表；reader 只读共享表，不碰交易所；
+        # auto 由文件锁选出唯一的 publisher，其余进程当 reader，publisher 挂了由 reader 接管
+        self.role = role
+        self.table_path = table_path or default_price_table_path()
+        self.table = None
+        self.table_seq = -1
+        self.lock_fd = None
+        self.auto = role == "auto"
+        # autostart=False 只建对象不起线程，由调用方自己驱动 _update_cycle (压测、批处理)
+        if not autostart: return
+        if role == "auto":
+            self.lock_fd = try_lock_publisher(self.table_path)
+            role = "publisher" if self.lock_fd is not None else "reader"
+        if role == "reader":
+            self.role = "reader"
+            self.thread = threading.Thread(target=self._reader_loop, daemon=True)
+            self.thread.start()
+        else:
+            self._start_publishing(role == "publisher")
+
+    def _start_publishing(self, shared):
+        if shared:
+            self.role = "publisher"
+            self.table = SharedPriceTable(self.table_path, writer=True)
         self.thread = threading.Thread(target=self._update_loop, daemon=True)
         self.thread.start()
+        if self.feed == "stream":
+            self.stream_thread = threading.Thread(target=self._stream_loop, daemon=True)
+            self.stream_thread.start()
 
     def update_targets(self, symbols_list):
         """接收外部传入的持仓币种，加入关注列表"""
@@ -43,83 +607,432 @@ class MarketData:
             new_targets = set(s for s in symbols_list if s not in ['USD'])
             if new_targets:
                 self.targets.update(new_targets)
+                self.scheduler.touch(new_targets)
+        # 读进程自己不抓价，把关注的币种登记到共享表里让写进程去抓
+        if self.role == "reader" and self.table is not None and new_targets:
+            self.table.want(new_targets)
+
+    def _pair_list(self):
+        """推送流要订阅的交易对，按 Kraken 的索引解析"""
+        with self.lock:
+            current_targets = list(self.targets)
+        return self.stream_venue.pair_list(current_targets)
+
+    @property
+    def stream_live(self):
+        return self.feed == "stream" and time.time() - self.stream_last_msg < STREAM_STALE_SEC
+
+    def _stream_gaps(self, symbols, now):
+        """symbols 里推送流最近 STREAM_STALE_SEC 没推过报价的 (订阅被拒、交易对解析不到、一直没成交)，这些由轮询补上"""
+        venue = self.stream_venue
+        return [s for s in symbols
+                if not all(now - self.stream_seen.get(p, 0) < STREAM_STALE_SEC for p in venue.pair_list([s]) or [None])]
 
     def _update_loop(self):
         while self.running:
-            tickers = {}
-            try:
-                # --- 尝试方案 A: 极速精准抓取 (只抓持仓币) ---
-                fetch_list = []
-                with self.lock:
-                    current_targets = list(self.targets)
-                
-                for symbol in current_targets:
-                    s = symbol.strip().upper()
-                    # 拼接 Kraken 需要的格式
-                    if '/' not in s:
-                        fetch_list.append(f"{s}/USD")
-                    else:
-                        fetch_list.append(s)
-
-                if fetch_list:
-                    # 尝试抓取指定列表。如果列表里有 Kraken 不支持的币(如BNB)，这里可能会抛异常
-                    tickers = self.exchange.fetch_tickers(fetch_list)
-                
-            except Exception:
-                # --- 尝试方案 B: 兼容模式 (如果方案A报错，则抓全量) ---
-                # 这能防止因为持有一个不支持的币导致整个价格卡死
-                try:
-                    tickers = self.exchange.fetch_tickers() 
-                except:
-                    pass # 网络彻底挂了，静默重试
+            time.sleep(self._update_cycle())
 
-            # --- 统一更新数据 ---
-            if tickers:
+    def _update_cycle(self):
+        """一轮轮询: 抓到期的币种、折算交叉汇率、记历史；返回离下一轮还要睡多久"""
+        now = time.time()
+        if self.table is not None:
+            self.table.beat()
+            wanted = self.table.wanted(now - TARGET_IDLE_TTL)
+            if wanted:
                 with self.lock:
-                    for symbol, ticker in tickers.items():
-                        if not ticker or ticker['last'] is None: continue
-                        price = float(ticker['last'])
-                        
-                        self.prices[symbol] = price
-                        
-                        # 智能拆解: 将 ETH/USD 拆解为 ETH 供查询
-                        if '/' in symbol:
-                            parts = symbol.split('/')
-                            base = parts[0]
-                            quote = parts[1]
-                            # 只要 Quote 是法币或主流稳定币，就认为 Base 的价格有效
-                            if quote in ['USD', 'USDT', 'USDC', 'DAI', 'ZUSD']:
-                                self.prices[base] = price
-                                self.prices[f"{base}/USD"] = price
-            
-            # 2秒更新一次，配合前端刷新
-            time.sleep(2)
+                    self.targets.update(wanted)
+                    for s, at in wanted.items(): self.scheduler.touch([s], at)
+        self._evict_idle(now)
+        live = self.stream_live
+        # 推送流要靠索引解析订阅的交易对，Kraken 本轮就算不用轮询也要保证索引在
+        if self.feed == "stream": self.stream_venue.ensure_market_index()
+        with self.lock:
+            due = self.scheduler.due(self.targets, now)
+        # 各交易所并行抓取到期的币种；还在跑上一轮或在退避中的交易所本轮跳过，最多等 VENUE_TIMEOUT。
+        # 推送流正常时 Kraken 只轮询流里没有推过来的币种，其余的不再占用 REST 配额
+        if due:
+            gaps = self._stream_gaps(due, now) if live else due
+            pending = []
+            for v in self.venues:
+                targets = gaps if v is self.stream_venue else due
+                if not targets or not v.available(): continue
+                v.pending = self.pool.submit(self._poll_venue, v, targets)
+                pending.append(v.pending)
+            if pending: wait(pending, timeout=VENUE_TIMEOUT)
+            moves = {s: self._recent_move(s) for s in due}
+            with self.lock: self.scheduler.schedule(due, now, moves)
+        self._derive_cross_rates()
+        self._record_history()
+        with self.lock:
+            return self.scheduler.sleep_for(self.targets, time.time())
+
+    def _recent_move(self, symbol):
+        """最近 POLL_VOL_WINDOW 秒的振幅 (相对)，历史不够时返回 None"""
+        ts, px = self._history(symbol, time.time() - POLL_VOL_WINDOW)
+        if len(px) < 2 or px[-1] <= 0: return None
+        return float((px.max() - px.min()) / px[-1])
+
+    def _evict_idle(self, now):
+        """没人要的币种移出关注列表，历史环形缓冲和报价 (连同 X/USD 这类派生键) 一起释放，再发布一次快照。
+        还在当桥接币 (别的关注币种按它计价) 的报价留着，换算要用"""
+        with self.lock:
+            idle = self.scheduler.idle(self.targets, now)
+            if not idle: return
+            self.targets.difference_update(idle)
+            self.scheduler.forget(idle)
+            for s in idle: self.history.pop(s, None)
+            idle = set(idle)
+            bridges = {k.split('/')[1] for k in self.quotes if '/' in k and k.split('/')[0] in self.targets}
+            drop = [k for k in self.quotes if k.split('/')[0] in idle and k.split('/')[0] not in bridges]
+            for k in drop:
+                self.prices.pop(k, None); self.quotes.pop(k, None)
+                self.venue_quotes.pop(k, None); self.spreads.pop(k, None)
+            if drop: self._publish(force=True)
+
+    @property
+    def exchange(self):
+        return self.venues[0].exchange
+
+    def _poll_venue(self, venue, targets):
+        try:
+            with metrics.timer("price_fetch_seconds", venue=venue.id):
+                tickers = venue.fetch(targets)
+            venue.record_success()
+            metrics.inc("price_fetch_total", venue=venue.id)
+            self._apply_tickers(tickers, venue.id)
+        except ccxt.BadSymbol as e:
+            # 索引过期 (比如刚下架的交易对)，下一轮重建索引，不再退回全量抓取
+            metrics.error(f"poll:{venue.id}", e)
+            venue.index_loaded_at = 0.0
+        except Exception as e:
+            metrics.error(f"poll:{venue.id}", e)
+            venue.record_failure() # 网络挂了或交易所抽风，累计到熔断器
+
+    def _apply_tickers(self, tickers, source):
+        """统一更新数据 (轮询和推送共用)"""
+        if not tickers: return
+        now = time.time()
+        with self.lock:
+            for symbol, ticker in tickers.items():
+                if not ticker or ticker.get('last') is None: continue
+                price = float(ticker['last'])
+                ts = ticker['timestamp'] / 1000 if isinstance(ticker.get('timestamp'), (int, float)) else now
+                if ticker.get('bid') and ticker.get('ask') and price > 0:
+                    self.spreads[symbol] = (float(ticker['ask']) - float(ticker['bid'])) / price
+                keys = [symbol]
+                # 智能拆解: 将 ETH/USD 拆解为 ETH 供查询
+                if '/' in symbol:
+                    base, quote = symbol.split('/')[:2]
+                    # 只要 Quote 是法币或主流稳定币，就认为 Base 的价格有效
+                    if quote in USD_QUOTES:
+                        keys += [base, f"{base}/USD"]
+                for key in keys:
+                    self.venue_quotes.setdefault(key, {})[source] = (price, ts)
+                    self._select_quote(key, now)
+            # 轮询结果一批一发；推送流逐条到，攒一下再发
+            self._publish(force=source != STREAM_SOURCE)
+
+    def _select_quote(self, key, now):
+        """新鲜报价里取优先级最高的；都不新鲜就取最新的 (调用方持锁)"""
+        candidates = self.venue_quotes[key]
+        fresh = [s for s, (_, ts) in candidates.items() if now - ts < QUOTE_MAX_AGE]
+        if fresh: source = min(fresh, key=lambda s: self.priority.get(s, len(self.priority)))
+        else: source = max(candidates, key=lambda s: candidates[s][1])
+        price, ts = candidates[source]
+        self.prices[key] = price
+        self.quotes[key] = (price, source, ts)
+
+    def _derive_cross_rates(self):
+        """每轮对整个报价快照跑一次换算图，给没有直接美元报价的币种补上折算价"""
+        with self.lock:
+            pairs = {k: q[0] for k, q in self.quotes.items() if '/' in k}
+            times = {k: q[2] for k, q in self.quotes.items() if '/' in k}
+            spreads = dict(self.spreads)
+        if not pairs: return
+        derived = derive_usd_prices(pairs, spreads, times)
+        with self.lock:
+            for asset, (price, path, ts) in derived.items():
+                # 直接报价 (USD/稳定币交易对) 始终优先
+                if len(path) <= 2: continue
+                current = self.quotes.get(asset)
+                if current and not current[1].startswith("cross:"): continue
+                self.prices[asset] = price
+                self.quotes[asset] = (price, "cross:" + ">".join(path), ts)
+            self._publish(force=True)
+
+    def _record_history(self):
+        """每轮把关注币种的当前价写进各自的环形缓冲"""
+        snap = self.snapshot
+        with self.lock:
+            for symbol in self.targets:
+                price = snap.lookup(symbol)
+                if not price: continue
+                ring = self.history.get(symbol)
+                if ring is None: ring = self.history[symbol] = PriceRing()
+                ring.append(snap.published_at, price)
+
+    def _history(self, symbol, since=None):
+        with self.lock:
+            ring = self.history.get(symbol.upper().strip())
+            if ring is None: return np.empty(0), np.empty(0)
+            return ring.arrays(since)
+
+    def price_ago(self, symbol, seconds):
+        """seconds 秒前的价格 (历史不够长时返回最早一笔)，返回 (价格, 时间)，没有历史返回 None"""
+        ts, px = self._history(symbol)
+        return price_at(ts, px, time.time() - seconds)
+
+    def rolling_min_max(self, symbol, seconds):
+        ts, px = self._history(symbol, time.time() - seconds)
+        if not len(px): return None
+        return float(px.min()), float(px.max())
+
+    def ohlc(self, symbol, bucket_seconds, seconds=HISTORY_SECONDS):
+        ts, px = self._history(symbol, time.time() - seconds)
+        return downsample_ohlc(ts, px, bucket_seconds)
+
+    def _gauges(self):
+        """指标抓取时调用: 关注列表大小、快照版本、每个关注币种的报价新鲜度 (秒)"""
+        now = time.time()
+        snap = self.snapshot
+        with self.lock: targets = sorted(self.targets)
+        out = [("price_targets", {}, len(targets)), ("price_snapshot_version", {}, snap.version)]
+        for s in targets:
+            quote = self.get_quote(s)
+            if quote: out.append(("price_staleness_seconds", {'symbol': s, 'source': quote['source']}, round(now - quote['timestamp'], 3)))
+        return out
+
+    def _publish(self, force=False):
+        """复制工作副本，整体替换 snapshot 引用 (调用方持锁，引用赋值本身是原子的)。
+        距上次发布不到 PUBLISH_INTERVAL 且不是 force 时只记下有改动，由 _flush_publish 补发"""
+        self.dirty = True
+        now = time.time()
+        if not force and now - self.snapshot.published_at < PUBLISH_INTERVAL: return
+        self.snapshot = PriceSnapshot(self.snapshot.version + 1, MappingProxyType(dict(self.prices)),
+                                      MappingProxyType(dict(self.quotes)), now)
+        if self.table is not None and self.table.writer: self.table.write(self.quotes)
+        self.dirty = False
+
+    def _flush_publish(self):
+        """攒着的改动到时间了就发出去 (推送循环每次收消息前调用)"""
+        if not self.dirty: return
+        with self.lock:
+            if self.dirty: self._publish()
+
+    # --- 共享价格表的读进程 ---
+    def _reader_loop(self):
+        while self.running and self.role == "reader":
+            try:
+                if self.table is None:
+                    self.table = SharedPriceTable(self.table_path)
+                    with self.lock: self.table.want(self.targets)
+                self._sync_from_table()
+                self._evict_idle(time.time())
+            except (FileNotFoundError, ValueError):
+                pass # 写进程还没建表
+            if self.lock_fd is None and self._publisher_stale():
+                self.lock_fd = try_lock_publisher(self.table_path)
+                if self.lock_fd is not None:
+                    self._start_publishing(True)
+                    return
+            time.sleep(PRICE_TABLE_POLL)
+
+    def _publisher_stale(self):
+        # 只有 auto 模式会接管；显式 reader 就一直等写进程回来
+        if not self.auto: return False
+        return self.table is None or time.time() - self.table.heartbeat > PRICE_TABLE_STALE
+
+    def _sync_from_table(self):
+        """表的版本号变了才整体读一遍，替换成新快照"""
+        seq = self.table.seq
+        if seq != self.table_seq:
+            quotes = self.table.read()
+            with self.lock:
+                self.quotes = quotes
+                self.prices = {k: q[0] for k, q in quotes.items()}
+                self._publish(force=True)
+            self.table_seq = seq
+        self._record_history()
+
+    # --- WebSocket 推送 (Kraken v2 ticker 协议，replay_server.py 也说同一种协议) ---
+    def _stream_loop(self):
+        asyncio.run(self._stream_main())
+
+    async def _stream_main(self):
+        import websockets
+        backoff = 1
+        while self.running:
+            try:
+                async with websockets.connect(self.stream_url, ping_interval=20) as ws:
+                    subscribed = set()
+                    backoff = 1
+                    while self.running:
+                        wanted = set(self._pair_list())
+                        pairs = wanted - subscribed
+                        if pairs:
+                            await ws.send(json.dumps({"method": "subscribe", "params": {"channel": "ticker", "symbol": sorted(pairs)}}))
+                            subscribed |= pairs
+                        # 被淘汰的币种退订，推送量跟着关注列表缩小
+                        dropped = subscribed - wanted
+                        if dropped:
+                            await ws.send(json.dumps({"method": "unsubscribe", "params": {"channel": "ticker", "symbol": sorted(dropped)}}))
+                            subscribed -= dropped
+                            for p in dropped: self.stream_seen.pop(p, None)
+                        self._flush_publish()
+                        try:
+                            # 有没发布的改动时等得短一点，最后一批报价不会一直压着
+                            raw = await asyncio.wait_for(ws.recv(), timeout=PUBLISH_INTERVAL if self.dirty else 1)
+                        except asyncio.TimeoutError:
+                            continue
+                        self._on_stream_message(raw)
+            except Exception as e:
+                metrics.error("stream", e) # 断流: stream_live 过期后轮询线程自动接管
+            self.stream_stats['reconnects'] += 1
+            await asyncio.sleep(backoff * random.uniform(0.5, 1.0))
+            backoff = min(backoff * 2, 30)
+
+    def _on_stream_message(self, raw):
+        msg = json.loads(raw)
+        self.stream_last_msg = time.time()
+        self.stream_stats['messages'] += 1
+        if msg.get('channel') != 'ticker' or not msg.get('data'): return
+        tickers = {item['symbol']: {'last': item.get('last')} for item in msg['data'] if 'symbol' in item}
+        self._apply_tickers(tickers, STREAM_SOURCE)
+        for p, t in tickers.items():
+            if t['last'] is not None: self.stream_seen[p] = self.stream_last_msg
+        self.stream_stats['updates'] += len(tickers)
+        metrics.inc("price_stream_updates_total", len(tickers))
+        # 回放服务器会给每条数据打上发送时间，用于测端到端延迟
+        sent = msg['data'][-1].get('timestamp')
+        if sent:
+            self.stream_stats['latency_ms'] = (self.stream_last_msg - datetime.datetime.fromisoformat(sent).timestamp()) * 1000
 
     def get_price(self, symbol: str) -> float:
+        return self.snapshot.lookup(symbol)
+
+    def get_prices(self, symbols) -> pd.Series:
+        """批量取价: 一次快照读取，结果按输入顺序对齐，查不到的是 0.0"""
+        snap = self.snapshot
+        symbols = list(symbols)
+        return pd.Series(np.fromiter((snap.lookup(s) for s in symbols), float, len(symbols)), index=symbols)
+
+    def get_quote(self, symbol: str):
+        """带来源和时间的报价: {'price', 'source', 'timestamp'}，没有报价返回 None"""
         lookup = symbol.upper().strip()
-        with self.lock:
-            if lookup in self.prices: return self.prices[lookup]
-            # 常见变体检查
-            for k in [f"{lookup}/USD", f"{lookup}/USDT"]:
-                if k in self.prices: return self.prices[k]
-        
-        # 稳定币兜底
-        if lookup in ['USDC', 'USDT', 'DAI', 'BUSD', 'FDUSD']: return 1.0
-        
-        return 0.0
+        quotes = self.snapshot.quotes
+        for k in [lookup, f"{lookup}/USD", f"{lookup}/USDT"]:
+            if k in quotes:
+                price, source, ts = quotes[k]
+                return {'price': price, 'source': source, 'timestamp': ts}
+        return None
 
 @st.cache_resource
 def get_market_data_instance():
-    return MarketData()
+    # PRICE_FEED=stream 打开推送模式；PRICE_STREAM_URL 可以指向本地 replay_server.py
+    # PRICE_EXCHANGES 按优先级列出要并行轮询的交易所，如 "kraken,coinbase,binance"
+    exchanges = [x.strip() for x in os.environ.get("PRICE_EXCHANGES", "kraken").split(",") if x.strip()]
+    # PRICE_ROLE=auto 时同一台机器上的多个 Streamlit 进程只有一个去抓价，其余读共享价格表 (PRICE_TABLE_PATH)
+    return MarketData(feed=os.environ.get("PRICE_FEED", "poll"),
+                      stream_url=os.environ.get("PRICE_STREAM_URL", KRAKEN_WS_URL),
+                      exchanges=exchanges,
+                      role=os.environ.get("PRICE_ROLE", "standalone"),
+                      table_path=os.environ.get("PRICE_TABLE_PATH") or None)
 
 # ==========================================
-# 2. 数据库操作 (保持不变)
+# 2. 数据库操作 (带按用户的读缓存)
 # ==========================================
-def get_user_portfolio(supabase_client):
+DB_PAGE = 1000             # PostgREST 默认的 max-rows: 一个响应最多这么多行，多出来的被悄悄截掉
+
+def _pg_value(value):
+    # 值里可能有 PostgREST 的保留字符 (时间戳里的 . 和 :)，一律加双引号
+    return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+def _keyset_filter(keys, row):
+    """(k1, k2, ...) 严格排在 row 之后的 PostgREST or 条件: k1>a，或 k1=a 且 k2>b，……"""
+    parts = []
+    for i, key in enumerate(keys):
+        conds = [f"{k}.eq.{_pg_value(row[k])}" for k in keys[:i]] + [f"{key}.gt.{_pg_value(row[key])}"]
+        parts.append(conds[0] if len(conds) == 1 else f"and({','.join(conds)})")
+    return ",".join(parts)
+
+def iter_pages(build, keys=('id',), page=DB_PAGE):
+    """按 keys 排序的 keyset 分页，逐页产出行列表；每页都从上一页最后一行往后查，不会像 offset 那样越翻越慢。
+    build() 每次返回一个带好过滤条件的新查询，select 里要包含 keys，keys 组合起来唯一且没有空值。
+    拿到空页才算读完: 服务端的 max-rows 可能比 page 还小，短页不代表到底了"""
+    last = None
+    while True:
+        query = build()
+        if last is not None:
+            query = query.gt(keys[0], last[keys[0]]) if len(keys) == 1 else query.or_(_keyset_filter(keys, last))
+        for key in keys: query = query.order(key)
+        rows = query.limit(page).execute().data or []
+        if not rows: return
+        yield rows
+        last = rows[-1]
+
+QUERY_CACHE_TTL = 30        # 秒；写操作会立即失效，TTL 只是兜底其他进程的写入
+QUERY_CACHE_MAX = 2048      # 最多缓存多少条 (用户, 查询)，超过按最久未用淘汰
+
+class QueryCache:
+    """按 (查询, user_id) 缓存 Supabase 读结果，TTL + LRU 容量上限，带命中统计"""
+    def __init__(self, ttl=QUERY_CACHE_TTL, maxsize=QUERY_CACHE_MAX):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        # user_id -> 失效次数: 读库期间发生过失效，读到的就可能是写之前的旧数据，不能放进缓存
+        self.generations = {}
+        self.hits = self.misses = self.evictions = 0
+
+    def get_or_load(self, kind, user_id, loader):
+        key = (kind, user_id)
+        now = time.time()
+        with self.lock:
+            hit = self.entries.get(key)
+            if hit and hit[0] > now:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return hit[1]
+            self.misses += 1
+            generation = self.generations.get(user_id, 0)
+        value = loader()
+        with self.lock:
+            if self.generations.get(user_id, 0) != generation: return value
+            self.entries[key] = (now + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+        return value
+
+    def invalidate(self, user_id):
+        with self.lock:
+            self.generations[user_id] = self.generations.get(user_id, 0) + 1
+            for key in [k for k in self.entries if k[1] == user_id]:
+                del self.entries[key]
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'size': len(self.entries), 'hit_rate': self.hits / total if total else 0.0}
+
+@st.cache_resource
+def get_query_cache():
+    cache = QueryCache()
+    metrics.register_gauges("query_cache", lambda: [(f"query_cache_{k}", {}, v) for k, v in cache.stats().items()])
+    return cache
+
+def get_user_portfolio(supabase_client, user_id=None):
+    # 没给 user_id 时完全依赖 RLS 过滤，无法安全地按用户缓存，直接查
+    def load():
+        query = supabase_client.table("user_portfolios").select("*")
+        if user_id is not None: query = query.eq("user_id", user_id)
+        return query.execute().data
     try:
-        response = supabase_client.table("user_portfolios").select("*").execute()
-        return response.data
-    except: return []
+        if user_id is None: return load()
+        return get_query_cache().get_or_load("portfolio", user_id, load)
+    except Exception as e: metrics.error("get_user_portfolio", e); return []
 
 def upsert_user_asset(supabase_client, user_id, symbol, amount, avg_price):
     if avg_price == 0:
@@ -129,70 +1042,196 @@ def upsert_user_asset(supabase_client, user_id, symbol, amount, avg_price):
             try:
                 existing = supabase_client.table("user_portfolios").select("avg_buy_price").eq("user_id", user_id).eq("symbol", symbol).execute()
                 if existing.data: avg_price = existing.data[0]['avg_buy_price']
-            except: pass
+            except Exception as e: metrics.error("upsert_user_asset", e)
     
     data = {"user_id": user_id, "symbol": symbol.upper(), "amount": amount, "avg_buy_price": avg_price}
     supabase_client.table("user_portfolios").upsert(data, on_conflict="user_id, symbol").execute()
+    get_query_cache().invalidate(user_id)
+
+UPSERT_CHUNK = 500
+
+def upsert_user_assets_bulk(supabase_client, user_id, holdings):
+    """批量版 upsert_user_asset(avg_price=0): 一次查出现有成本价，内存合并后分块 upsert。
+    holdings: {symbol: amount}；返回 {'inserted', 'updated', 'unchanged'}"""
+    # 超过一页的持仓也要全读出来，否则后面的会被当成新币种，成本价被 0 覆盖
+    build = lambda: supabase_client.table("user_portfolios").select("symbol, amount, avg_buy_price").eq("user_id", user_id)
+    existing = {row['symbol']: row for rows in iter_pages(build, ('symbol',)) for row in rows}
+    counts = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+    rows = []
+    for symbol, amount in holdings.items():
+        sym = symbol.upper()
+        old = existing.get(sym)
+        # 和单条版一样: 稳定币成本记 1，其余沿用已有成本价
+        if sym in ['USDT', 'USDC', 'DAI', 'USD']: avg_price = 1.0
+        else: avg_price = float(old['avg_buy_price'] or 0) if old else 0
+        if old is None: counts['inserted'] += 1
+        elif float(old['amount'] or 0) == float(amount) and float(old['avg_buy_price'] or 0) == avg_price:
+            counts['unchanged'] += 1
+            continue
+        else: counts['updated'] += 1
+        rows.append({"user_id": user_id, "symbol": sym, "amount": amount, "avg_buy_price": avg_price})
+    for i in range(0, len(rows), UPSERT_CHUNK):
+        supabase_client.table("user_portfolios").upsert(rows[i:i + UPSERT_CHUNK], on_conflict="user_id, symbol").execute()
+    if rows: get_query_cache().invalidate(user_id)
+    return counts
 
 def delete_user_asset(supabase_client, user_id, symbol):
     try: supabase_client.table("user_portfolios").delete().eq("user_id", user_id).eq("symbol", symbol).execute()
-    except: pass
+    except Exception as e: metrics.error("delete_user_asset", e)
+    get_query_cache().invalidate(user_id)
 
 def reset_user_portfolio(supabase_client, user_id):
     try: supabase_client.table("user_portfolios").delete().eq("user_id", user_id).execute()
-    except: pass
+    except Exception as e: metrics.error("reset_user_portfolio", e)
+    get_query_cache().invalidate(user_id)
+
+DEFAULT_NET_WORTH_GOAL = 100000.0   # 用户没设过目标时用的净值目标
 
 def get_user_goal(supabase_client, user_id):
-    try:
+    def load():
         res = supabase_client.table("user_settings").select("net_worth_goal").eq("user_id", user_id).execute()
-        return float(res.data[0]['net_worth_goal']) if res.data else 100000.0
-    except: return 100000.0
+        return float(res.data[0]['net_worth_goal']) if res.data else DEFAULT_NET_WORTH_GOAL
+    try: return get_query_cache().get_or_load("goal", user_id, load)
+    except Exception as e: metrics.error("get_user_goal", e); return DEFAULT_NET_WORTH_GOAL
 
 def upsert_user_goal(supabase_client, user_id, goal):
     supabase_client.table("user_settings").upsert({"user_id": user_id, "net_worth_goal": goal}).execute()
+    get_query_cache().invalidate(user_id)
 
 # ==========================================
 # 3. 计算逻辑 (已连接自动同步)
 # ==========================================
+EMPTY_TOTALS = {'net_worth': 0.0, 'cost': 0.0, 'pnl': 0.0, 'pnl_pct': 0.0}
+
+@metrics.timed("dashboard_compute_seconds")
 def calculate_dashboard_data(portfolio_data, market_data):
-    if not portfolio_data: return pd.DataFrame()
+    """返回 (持仓表, 汇总)；汇总里是 net_worth / cost / pnl / pnl_pct，面板直接用，不用再算一遍"""
+    if not portfolio_data: return pd.DataFrame(), dict(EMPTY_TOTALS)
+    frame = pd.DataFrame.from_records(portfolio_data, columns=['symbol', 'amount', 'avg_buy_price'])
     
     # 🔥 关键步骤：把用户的持仓币种告诉后台，让它优先抓取这些
-    user_symbols = [item['symbol'] for item in portfolio_data]
-    market_data.update_targets(user_symbols)
+    market_data.update_targets(frame['symbol'].tolist())
 
-    rows = []
-    for item in portfolio_data:
-        sym = item['symbol']
-        amt = float(item['amount'])
-        avg = float(item['avg_buy_price'])
-        if amt <= 0: continue
-        price = market_data.get_price(sym)
-        if price == 0: price = avg 
-        val = amt * price
-        pnl = (price - avg) * amt
-        pct = ((price - avg) / avg * 100) if avg > 0 else 0
-        rows.append({"Symbol": sym, "Amount": amt, "Avg Buy Price": avg, "Current Price": price, "Current Value": val, "P&L %": pct})
-    return pd.DataFrame(rows)
+    amt = pd.to_numeric(frame['amount']).to_numpy(float)
+    avg = pd.to_numeric(frame['avg_buy_price']).to_numpy(float)
+    held = amt > 0
+    sym, amt, avg = frame['symbol'].to_numpy()[held], amt[held], avg[held]
+    if not len(sym): return pd.DataFrame(), dict(EMPTY_TOTALS)
+
+    # 整个组合只读一次价格快照，查不到价格的按成本价计
+    price = market_data.get_prices(sym).to_numpy()
+    price = np.where(price == 0, avg, price)
+    val = amt * price
+    cost = amt * avg
+    pnl = val - cost
+    pct = np.divide((price - avg) * 100, avg, out=np.zeros_like(avg), where=avg > 0)
+    df = pd.DataFrame({"Symbol": sym, "Amount": amt, "Avg Buy Price": avg, "Current Price": price,
+                       "Current Value": val, "P&L": pnl, "P&L %": pct})
+
+    total_val, total_cost = float(val.sum()), float(cost.sum())
+    total_pnl = total_val - total_cost
+    totals = {'net_worth': total_val, 'cost': total_cost, 'pnl': total_pnl,
+              'pnl_pct': (total_pnl / total_cost * 100) if total_cost > 0 else 0.0}
+    return df, totals
+
+def calculate_period_change(df, market_data, seconds=86400):
+    """持仓在过去 seconds 秒里的市值变化: (变化额, 变化%, 实际覆盖的秒数)。
+    历史不够长时按最早的记录算，覆盖秒数会小于 seconds"""
+    if df.empty: return 0.0, 0.0, 0.0
+    now = time.time()
+    then_px = df['Current Price'].to_numpy(float).copy()
+    oldest = now
+    for i, sym in enumerate(df['Symbol']):
+        hit = market_data.price_ago(sym, seconds)
+        if hit is None: continue
+        then_px[i], ts = hit
+        oldest = min(oldest, ts)
+    amt = df['Amount'].to_numpy(float)
+    then_val = float((amt * then_px).sum())
+    change = float(df['Current Value'].sum()) - then_val
+    pct = (change / then_val * 100) if then_val > 0 else 0.0
+    return change, pct, min(now - oldest, seconds)
 
 # ==========================================
 # 4. 同步余额 (保持不变)
 # ==========================================
-def sync_exchange_holdings(supabase_client, user_id, exchange_id, api_key, api_secret, password=None):
+CLIENT_POOL_TTL = 900    # 带密钥的交易所客户端闲置多久关掉 (秒)
+
+class _PooledClient:
+    def __init__(self, client):
+        self.client = client
+        self.lock = threading.Lock()
+        self.used_at = time.time()
+
+class ExchangeClientPool:
+    """按 (交易所, 密钥指纹) 复用 ccxt 客户端: 已加载的市场列表和 HTTP 连接 (TLS 会话) 留给下一次同步。
+    同一个客户端同一时间只借给一个任务 (ccxt 客户端的限速状态不是线程安全的)，闲置超过 CLIENT_POOL_TTL 关掉"""
+    def __init__(self, ttl=CLIENT_POOL_TTL):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    @staticmethod
+    def fingerprint(api_key, api_secret, password=None):
+        # 只用哈希当键，明文密钥不进字典
+        return hashlib.sha256("\0".join((api_key or "", api_secret or "", password or "")).encode()).hexdigest()
+
+    @contextlib.contextmanager
+    def lease(self, exchange_id, api_key, api_secret, password=None):
+        key = (exchange_id, self.fingerprint(api_key, api_secret, password))
+        with self.lock:
+            self._evict(time.time())
+            entry = self.entries.get(key)
+            if entry is None:
+                config = {'apiKey': api_key, 'secret': api_secret, 'enableRateLimit': True, 'options': {'defaultType': 'spot'}}
+                if password: config['password'] = password
+                entry = self.entries[key] = _PooledClient(getattr(ccxt, exchange_id)(config))
+                metrics.inc("client_pool_total", venue=exchange_id, result="miss")
+            else:
+                metrics.inc("client_pool_total", venue=exchange_id, result="hit")
+        with entry.lock:
+            try: yield entry.client
+            finally: entry.used_at = time.time()
+
+    def _evict(self, now):
+        """调用方持锁；正被借用的客户端不动"""
+        for key, entry in list(self.entries.items()):
+            if now - entry.used_at > self.ttl and entry.lock.acquire(blocking=False):
+                del self.entries[key]
+                entry.lock.release()
+                _close_client(entry.client)
+
+    def clear(self):
+        with self.lock:
+            entries, self.entries = list(self.entries.values()), {}
+        for entry in entries: _close_client(entry.client)
+
+def _close_client(client):
+    session = getattr(client, 'session', None)
+    if session is not None:
+        try: session.close()
+        except Exception as e: metrics.error("client_pool_close", e)
+
+@st.cache_resource
+def get_client_pool():
+    pool = ExchangeClientPool()
+    metrics.register_gauges("client_pool", lambda: [("client_pool_size", {}, len(pool.entries))])
+    return pool
+
+def sync_exchange_holdings(supabase_client, user_id, exchange_id, api_key, api_secret, password=None, job=None):
     try:
-        exchange_class = getattr(ccxt, exchange_id)
-        config = {'apiKey': api_key, 'secret': api_secret, 'enableRateLimit': True, 'options': {'defaultType': 'spot'}}
-        if password: config['password'] = password
-        exchange = exchange_class(config)
-        balance = exchange.fetch_balance()
-        assets = balance['total']
-        count = 0
-        for symbol, amount in assets.items():
-            if amount > 0:
-                upsert_user_asset(supabase_client, user_id, symbol, amount, 0)
-                count += 1
-        return True, f"Synced {count} assets!"
-    except Exception as e: return False, f"Sync Error: {str(e)}"
+        with get_client_pool().lease(exchange_id, api_key, api_secret, password) as exchange:
+            balance = exchange.fetch_balance()
+        holdings = {symbol: amount for symbol, amount in balance['total'].items() if amount and amount > 0}
+        if job is not None:
+            if job.cancelled(): return False, "Cancelled"
+            job.progress['assets_total'] = len(holdings)
+        counts = upsert_user_assets_bulk(supabase_client, user_id, holdings)
+        if job is not None: job.progress['assets_written'] = counts['inserted'] + counts['updated']
+        return True, f"Synced {len(holdings)} assets! ({counts['inserted']} new, {counts['updated']} updated, {counts['unchanged']} unchanged)"
+    except Exception as e:
+        metrics.error("sync_exchange_holdings", e)
+        return False, f"Sync Error: {str(e)}"
 
 # ==========================================
 # 5. 核心：同步历史 (保持不变)
@@ -200,25 +1239,298 @@ def sync_exchange_holdings(supabase_client, user_id, exchange_id, api_key, api_s
 def add_transaction(supabase, user_id, symbol, type, qty, price, date):
     data = {"user_id": user_id, "symbol": symbol.upper(), "type": type, "quantity": qty, "price": price, "timestamp": date.isoformat()}
     supabase.table("transactions").insert(data).execute()
-    recalculate_single_asset(supabase, user_id, symbol)
+    if type == 'BUY': apply_cost_basis_delta(supabase, user_id, symbol, qty, price)
+    get_query_cache().invalidate(user_id)
 
-def get_transaction_history(supabase, user_id):
+def get_transaction_history(supabase, user_id, symbol=None):
+    """按 (时间, id) 顺序分页读出全部成交"""
+    def build():
+        query = supabase.table("transactions").select("*").eq("user_id", user_id)
+        return query.eq("symbol", symbol) if symbol else query
     try:
-        res = supabase.table("transactions").select("*").eq("user_id", user_id).order("timestamp").execute()
-        return pd.DataFrame(res.data) if res.data else pd.DataFrame()
-    except: return pd.DataFrame()
+        rows = [r for page in iter_pages(build, ('timestamp', 'id')) for r in page]
+        return pd.DataFrame(rows) if rows else pd.DataFrame()
+    except Exception as e: metrics.error("get_transaction_history", e); return pd.DataFrame()
+
+def get_transactions_since(supabase, user_id, last_id=None):
+    """按自增 id 分页取 last_id 之后写入的成交 (last_id 为空则取全部)"""
+    def build():
+        query = supabase.table("transactions").select("*").eq("user_id", user_id)
+        return query.gt("id", last_id) if last_id is not None else query
+    rows = [r for page in iter_pages(build) for r in page]
+    return pd.DataFrame(rows) if rows else pd.DataFrame()
+
+def count_transactions(supabase, user_id):
+    res = supabase.table("transactions").select("id", count="exact", head=True).eq("user_id", user_id).execute()
+    return res.count or 0
+
+def ledger_fingerprint(supabase, user_id):
+    """(行数, 最大 id)，一次请求；用来发现别处的删除和插入"""
+    res = supabase.table("transactions").select("id", count="exact").eq("user_id", user_id).order("id", desc=True).limit(1).execute()
+    return res.count or 0, (int(res.data[0]['id']) if res.data else None)
+
+def clear_all_transactions(supabase, user_id):
+    supabase.table("transactions").delete().eq("user_id", user_id).execute()
+    try: supabase.table("cost_basis").delete().eq("user_id", user_id).execute()
+    except Exception as e: metrics.error("clear_all_transactions", e)
+    get_tax_checkpoints().invalidate(user_id)
+
+# --- 账本分页: 排序、过滤、分页都交给数据库，界面一次只拿一页 ---
+LEDGER_PAGE_SIZE = 50
+LEDGER_SORT_COLUMNS = ('timestamp', 'symbol', 'type', 'quantity', 'price')
+LEDGER_COLUMNS = "id, timestamp, type, symbol, quantity, price, exchange"
+DELETE_CHUNK = 200   # 批量删除每条请求带多少个 id (id 列表在 URL 里，不能太长)
+
+def get_ledger_page(supabase, user_id, page=0, page_size=LEDGER_PAGE_SIZE, sort='timestamp', descending=True,
+                    symbols=None, types=None, start=None, end=None):
+    """按条件取账本的第 page 页 (从 0 开始)；start/end 是日期，两端都包含。
+    返回 (DataFrame, 满足条件的总条数)"""
+    if sort not in LEDGER_SORT_COLUMNS: sort = 'timestamp'
+    query = supabase.table("transactions").select(LEDGER_COLUMNS, count="exact").eq("user_id", user_id)
+    if symbols: query = query.in_("symbol", [s.upper() for s in symbols])
+    if types: query = query.in_("type", list(types))
+    if start: query = query.gte("timestamp", start.isoformat())
+    if end: query = query.lt("timestamp", (end + datetime.timedelta(days=1)).isoformat())
+    # id 做第二排序键，同一时间的成交翻页时顺序稳定
+    query = query.order(sort, desc=descending).order("id", desc=descending)
+    first = page * page_size
+    res = query.range(first, first + page_size - 1).execute()
+    return (pd.DataFrame(res.data) if res.data else pd.DataFrame()), (res.count or 0)
+
+def delete_transactions(supabase, user_id, tx_ids):
+    """批量删除: 每块一条 DELETE ... WHERE id IN (...)；删掉的行已经在手上，
+    每个币种把删掉的 BUY 数量和成本一次性从累计值里减掉，不用按历史重算"""
+    tx_ids = list(tx_ids)
+    deleted = []
+    for i in range(0, len(tx_ids), DELETE_CHUNK):
+        res = supabase.table("transactions").delete().eq("user_id", user_id).in_("id", tx_ids[i:i + DELETE_CHUNK]).execute()
+        deleted.extend(res.data or [])
+    store = get_tax_checkpoints()
+    for symbol in {r['symbol'] for r in deleted}:
+        store.invalidate(user_id, symbol, removed=sum(1 for r in deleted if r['symbol'] == symbol))
+    removed = {}
+    for r in deleted:
+        if r['type'] != 'BUY': continue
+        qty, cost = removed.get(r['symbol'], (0.0, 0.0))
+        removed[r['symbol']] = (qty + float(r['quantity']), cost + float(r['quantity']) * float(r['price']))
+    for symbol, (qty, cost) in removed.items():
+        if qty > 0: apply_cost_basis_delta(supabase, user_id, symbol, qty, cost / qty, sign=-1)
+        else: recalculate_single_asset(supabase, user_id, symbol)
+    if removed: get_query_cache().invalidate(user_id)
+    return len(deleted)
+
+# --- 成本价: cost_basis 表按 (user_id, symbol) 存 BUY 的累计成本和累计数量 ---
+def apply_cost_basis_delta(supabase, user_id, symbol, qty, price, sign=1):
+    """单笔 BUY 写入 (sign=1) 或删除 (sign=-1) 之后 O(1) 更新累计值和均价。
+    还没有累计行 (老用户第一次) 或表不可用时，退回按历史重算这个币种。
+    读-改-写不是原子的，并发写同一币种时可以用 rebuild_cost_basis 修复"""
+    symbol = symbol.upper()
+    try:
+        res = supabase.table("cost_basis").select("total_cost, total_qty").eq("user_id", user_id).eq("symbol", symbol).execute()
+        if not res.data: return recalculate_single_asset(supabase, user_id, symbol)
+        total_cost = float(res.data[0]['total_cost']) + sign * qty * price
+        total_qty = float(res.data[0]['total_qty']) + sign * qty
+        if total_qty <= LOT_DUST: total_cost = total_qty = 0.0
+        supabase.table("cost_basis").upsert({"user_id": user_id, "symbol": symbol, "total_cost": total_cost, "total_qty": total_qty}, on_conflict="user_id, symbol").execute()
+        if total_qty > 0:
+            supabase.table("user_portfolios").update({"avg_buy_price": total_cost / total_qty}).eq("user_id", user_id).eq("symbol", symbol).execute()
+    except Exception as e: metrics.error("apply_cost_basis_delta", e); recalculate_single_asset(supabase, user_id, symbol)
 
 def recalculate_single_asset(supabase, user_id, symbol):
+    try: recalculate_assets(supabase, user_id, [symbol.upper()])
+    except Exception as e: metrics.error("recalculate_single_asset", e)
+
+def rebuild_cost_basis(supabase, user_id):
+    """修复操作: 按全部 BUY 历史重建该用户所有币种的累计值和均价。
+    先清掉旧的累计行，BUY 已经删光的币种不会留下过时的累计值 (重建中途的增量写入找不到累计行会自己重算)"""
+    supabase.table("cost_basis").delete().eq("user_id", user_id).execute()
+    recalculate_assets(supabase, user_id, None)
+
+def recalculate_assets(supabase, user_id, symbols):
+    """分页读出这些币种 (None 表示全部) 的所有 BUY，逐页分组累加成本和数量，求均价后分块写回"""
+    if symbols is not None:
+        symbols = sorted(set(symbols))
+        if not symbols: return
+    def build():
+        query = supabase.table("transactions").select("id, symbol, price, quantity").eq("user_id", user_id).eq("type", "BUY")
+        return query.in_("symbol", symbols) if symbols is not None else query
+    grouped = pd.DataFrame(columns=['cost', 'qty'], dtype=float)
+    for rows in iter_pages(build):
+        buys = pd.DataFrame(rows, columns=['symbol', 'price', 'quantity'])
+        qty = buys['quantity'].astype(float)
+        page = pd.DataFrame({'cost': buys['price'].astype(float) * qty, 'qty': qty, 'symbol': buys['symbol']}).groupby('symbol').sum()
+        grouped = page if grouped.empty else grouped.add(page, fill_value=0.0)
+    # 没有 BUY 的币种也写一行 0，之后的增量更新就有基数了
+    if symbols is not None: grouped = grouped.reindex(symbols, fill_value=0.0)
+    totals = [{"user_id": user_id, "symbol": s, "total_cost": float(r.cost), "total_qty": float(r.qty)} for s, r in grouped.iterrows()]
     try:
-        res = supabase.table("transactions").select("*").eq("user_id", user_id).eq("symbol", symbol).eq("type", "BUY").execute()
-        buys = res.data
-        if buys:
-            total_cost = sum([float(b['price']) * float(b['quantity']) for b in buys])
-            total_qty = sum([float(b['quantity']) for b in buys])
-            if total_qty > 0:
-                avg = total_cost / total_qty
-                supabase.table("user_portfolios").update({"avg_buy_price": avg}).eq("user_id", user_id).eq("symbol", symbol).execute()
-    except: pass
+        for i in range(0, len(totals), UPSERT_CHUNK):
+            supabase.table("cost_basis").upsert(totals[i:i + UPSERT_CHUNK], on_conflict="user_id, symbol").execute()
+    except Exception as e: metrics.error("recalculate_assets", e)
+    grouped = grouped[grouped['qty'] > 0]
+    if grouped.empty: return
+    avg = (grouped['cost'] / grouped['qty']).to_dict()
+    # 只更新已有持仓行的均价 (和单条版一样用 update)。不能带着先读出来的 amount 去 upsert:
+    # 同一用户的余额同步可能同时在跑，旧的数量会盖掉刚同步的新余额
+    build = lambda: supabase.table("user_portfolios").select("id, symbol").eq("user_id", user_id).in_("symbol", list(avg))
+    held = [r['symbol'] for page in iter_pages(build) for r in page]
+    for symbol in held:
+        supabase.table("user_portfolios").update({"avg_buy_price": avg[symbol]}).eq("user_id", user_id).eq("symbol", symbol).execute()
+    if held: get_query_cache().invalidate(user_id)
+
+def upsert_transactions_bulk(supabase, rows, job=None):
+    """按 (user_id, exchange, trade_id) 去重后分块 upsert；同一批里重复的键会让 Postgres 报错"""
+    unique = list({(r['user_id'], r['exchange'], r['trade_id']): r for r in rows}.values())
+    for i in range(0, len(unique), UPSERT_CHUNK):
+        chunk = unique[i:i + UPSERT_CHUNK]
+        res = supabase.table("transactions").upsert(chunk, on_conflict="user_id, exchange, trade_id").execute()
+        # 撞上已有 trade_id 的是原地更新，id 不变，税务检查点自己发现不了
+        get_tax_checkpoints().updated(res.data or [])
+        if job is not None: job.progress['trades_written'] = i + len(chunk)
+    return len(unique)
+
+OHLCV_CACHE_DIR = os.environ.get("OHLCV_CACHE_DIR") or os.path.join(tempfile.gettempdir(), "crypto_quant_ohlcv")
+OHLCV_TIMEFRAMES = ('1h', '1d')   # 先用小时线，交易所给不到那么早的 (Kraken 只给最近 720 根) 再用日线
+OHLCV_PAGE = 500                  # 每次向交易所要多少根
+OHLCV_MAX_GAP = 24                # 目标时刻往前最多隔几根没成交的 K 线，再远就当查不到
+OHLCV_QUOTES = ('USD', 'USDT', 'USDC')
+
+class OhlcvCache:
+    """历史 K 线的本地缓存: 每个 (交易所, 交易对, 周期) 一个 .npy 文件，6 行 (时间毫秒/开/高/低/收/量) 按列连续存放，
+    读的时候 mmap 进来二分查找；旁边的 .json 记录已经向交易所要过的时间区间，区间内查不到的也不会再请求"""
+    COLUMNS = ('ts', 'open', 'high', 'low', 'close', 'volume')
+
+    def __init__(self, root=OHLCV_CACHE_DIR):
+        self.root = root
+        self.lock = threading.Lock()
+        self.maps = {}    # 路径 -> mmap 出来的数组，文件换掉时丢弃
+
+    def _path(self, exchange_id, pair, timeframe):
+        return os.path.join(self.root, exchange_id, f"{pair.replace('/', '_')}_{timeframe}")
+
+    def _load(self, path):
+        """(K 线数组, 已覆盖区间列表)；没有缓存时是空的"""
+        try:
+            with open(path + ".json") as f: spans = json.load(f)
+        except FileNotFoundError: return np.zeros((len(self.COLUMNS), 0)), []
+        if path not in self.maps: self.maps[path] = np.load(path + ".npy", mmap_mode='r')
+        return self.maps[path], spans
+
+    def _save(self, path, candles, spans):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 先写数组再写区间，两个都是临时文件改名；读者拿着旧 mmap 也不受影响
+        for suffix, write in ((".npy", lambda f: np.save(f, candles)), (".json", lambda f: json.dump(spans, f))):
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb" if suffix == ".npy" else "w") as f: write(f)
+                os.replace(tmp, path + suffix)
+            except BaseException:
+                os.unlink(tmp)
+                raise
+        self.maps.pop(path, None)
+
+    @staticmethod
+    def _covered(spans, when):
+        when = np.asarray(when, dtype=np.float64)
+        hit = np.zeros(len(when), dtype=bool)
+        for lo, hi in spans: hit |= (when >= lo) & (when < hi)
+        return hit
+
+    @staticmethod
+    def _merge_spans(spans):
+        out = []
+        for lo, hi in sorted(spans):
+            if out and lo <= out[-1][1]: out[-1][1] = max(out[-1][1], hi)
+            else: out.append([lo, hi])
+        return out
+
+    def _fetch(self, exchange, pair, timeframe, when, candles, spans):
+        """按缺的时刻从早到晚翻页，一页能盖住的时刻不再单独请求。已覆盖区间从 since 记到这一页最后一根 K 线
+        (Coinbase 一页最多 300 根，比要的少，后面的下次接着要)；页从 since 之后才开始的 (没上市、Kraken 太早的
+        只给最近 720 根) 前面那段也记上，交易所给不了，查到是 NaN，由调用方换日线，不会每次同步都再要一遍。
+        空页什么也不记。还没收盘的那根不算，下次查到会重新要"""
+        step = exchange.parse_timeframe(timeframe) * 1000
+        open_candle = exchange.milliseconds() // step * step
+        fetched, reach = [], -1
+        for t in np.sort(when):
+            if t < reach: continue
+            # 往前多要几根，目标时刻前面没成交时也能找到最近一根
+            since = int((t // step - OHLCV_MAX_GAP) * step)
+            page = [c for c in exchange.fetch_ohlcv(pair, timeframe, since, OHLCV_PAGE) or [] if None not in c[:5]]
+            metrics.inc("ohlcv_fetch_total", venue=exchange.id, timeframe=timeframe)
+            if not page:
+                reach = t + step
+                continue
+            fetched.append(np.array([c[:6] for c in page], dtype=np.float64).T)
+            end = min(page[-1][0] + step, open_candle)
+            reach = max(end, t + step)
+            if end > since: spans = self._merge_spans(spans + [[since, end]])
+        if not fetched: return candles, spans
+        merged = np.concatenate([np.asarray(candles)] + fetched, axis=1)
+        # 同一根 K 线以后要到的为准 (没收盘的那根会变)
+        merged = merged[:, np.argsort(merged[0], kind='stable')]
+        keep = np.append(merged[0, 1:] != merged[0, :-1], True)
+        return np.ascontiguousarray(merged[:, keep]), spans
+
+    def prices(self, exchange, pair, when, timeframe=OHLCV_TIMEFRAMES[0]):
+        """when (毫秒时间戳数组) 各个时刻的收盘价；缺的区间批量补齐后二分查找，查不到的是 NaN"""
+        when = np.asarray(when, dtype=np.float64)
+        path = self._path(exchange.id, pair, timeframe)
+        with self.lock:
+            candles, spans = self._load(path)
+            missing = when[~self._covered(spans, when)]
+            if len(missing):
+                candles, new_spans = self._fetch(exchange, pair, timeframe, missing, candles, spans)
+                if new_spans != spans:
+                    self._save(path, candles, new_spans)
+                    candles, spans = self._load(path)
+        out = np.full(len(when), np.nan)
+        ts = candles[0]
+        if not len(ts): return out
+        step = exchange.parse_timeframe(timeframe) * 1000
+        i = np.searchsorted(ts, when, side='right') - 1
+        ok = (i >= 0) & (when - ts[np.maximum(i, 0)] < step * OHLCV_MAX_GAP)
+        out[ok] = candles[4][i[ok]]
+        return out
+
+@st.cache_resource
+def get_ohlcv_cache():
+    return OhlcvCache()
+
+def backfill_prices(exchange, trades, cache=None):
+    """给 price 为 0 的成交 (兑换/账本记录) 补上成交时刻的历史收盘价，就地修改。
+    每个币种只解析一次交易对，所有时刻一次批量查；返回补上的条数"""
+    if not exchange.has.get('fetchOHLCV'): return 0
+    todo = {}
+    for t in trades:
+        if not t['price']: todo.setdefault(t['symbol'], []).append(t)
+    if not todo: return 0
+    cache = cache or get_ohlcv_cache()
+    markets = load_markets_cached(exchange)
+    filled = 0
+    for symbol, items in todo.items():
+        if symbol in STABLE_COINS or symbol in OHLCV_QUOTES:
+            for t in items: t['price'] = 1.0
+            filled += len(items)
+            continue
+        pair = next((f"{symbol}/{q}" for q in OHLCV_QUOTES if f"{symbol}/{q}" in markets), None)
+        if pair is None: continue
+        when = np.array([t['timestamp'].timestamp() * 1000 for t in items])
+        try:
+            px = np.full(len(items), np.nan)
+            for tf in OHLCV_TIMEFRAMES:
+                gap = np.isnan(px)
+                if not gap.any(): break
+                px[gap] = cache.prices(exchange, pair, when[gap], tf)
+        except Exception as e:
+            metrics.error("backfill_prices", e)
+            continue
+        for t, p in zip(items, px.tolist()):
+            if p == p and p > 0:
+                t['price'] = p
+                filled += 1
+    metrics.inc("price_backfill_total", filled)
+    return filled
 
 def fetch_special_converts(exchange, exchange_id):
     trades = []
@@ -235,7 +1547,7 @@ def fetch_special_converts(exchange, exchange_id):
                         cost_total = float(item['fromAmount'])
                         price = cost_total / qty if qty > 0 else 0
                         trades.append({'symbol': item['toAsset'], 'side': 'BUY', 'amount': qty, 'price': price, 'timestamp': ts, 'id': f"bin_conv_{item['orderId']}"})
-            except: pass
+            except Exception as e: metrics.error("fetch_special_converts", e)
         elif exchange_id == 'okx':
             try:
                 res = exchange.private_get_asset_convert_history()
@@ -245,7 +1557,7 @@ def fetch_special_converts(exchange, exchange_id):
                         qty = float(item['toAmt'])
                         price = float(item['price']) 
                         trades.append({'symbol': item['toCcy'], 'side': 'BUY', 'amount': qty, 'price': price, 'timestamp': ts, 'id': f"okx_conv_{item['orderId']}"})
-            except: pass
+            except Exception as e: metrics.error("fetch_special_converts", e)
         elif exchange_id in ['kraken', 'coinbase', 'kucoin']:
             if exchange.has['fetchLedger']:
                 try:
@@ -253,73 +1565,567 @@ def fetch_special_converts(exchange, exchange_id):
                     for item in ledger:
                         if item['type'] == 'trade' and float(item['amount']) > 0: 
                             trades.append({'symbol': item['currency'], 'side': 'BUY', 'amount': float(item['amount']), 'price': 0, 'timestamp': datetime.datetime.fromtimestamp(item['timestamp']/1000.0), 'id': str(item['id'])})
-                except: pass
-    except: pass
+                except Exception as e: metrics.error("fetch_special_converts", e)
+    except Exception as e: metrics.error("fetch_special_converts", e)
+    return trades
+
+SYNC_QUOTES = ['USDT', 'USD', 'USDC', 'BTC', 'ETH']
+SYNC_HISTORY_START = 1483228800000   # 2017-01-01，第一次同步从这里往后翻页
+SYNC_PAGE_LIMIT = 500
+# 交易所自带的成交翻页游标: 按时间翻页在同一毫秒的成交超过一页时翻不动，Kraken 的成交还是从新到旧给的
+TRADE_CURSORS = {
+    'binance': 'fromId',   # 从这个成交 id 起 (含)，不能和 startTime 一起传；只给 startTime 时只返回有限的时间窗
+    'kraken': 'ofs',       # 整个账户的成交按偏移量翻 (TradesHistory 不分交易对)，见 fetch_account_trades
+}
+
+def load_sync_watermarks(supabase, user_id, exchange_id):
+    """每个 (交易所, 交易对) 已经同步到的最后成交时间 (毫秒)；表不存在时当作从没同步过"""
+    try:
+        res = supabase.table("sync_watermarks").select("market, last_ts").eq("user_id", user_id).eq("exchange", exchange_id).execute()
+        return {row['market']: int(row['last_ts']) for row in res.data or []}
+    except Exception as e: metrics.error("load_sync_watermarks", e); return {}
+
+def save_sync_watermarks(supabase, user_id, exchange_id, marks):
+    if not marks: return
+    rows = [{"user_id": user_id, "exchange": exchange_id, "market": m, "last_ts": ts} for m, ts in marks.items()]
+    try: supabase.table("sync_watermarks").upsert(rows, on_conflict="user_id, exchange, market").execute()
+    except Exception as e: metrics.error("save_sync_watermarks", e)
+
+def fetch_market_trades(exchange, market, since, cancel=None):
+    """从 since (含，None 表示从没同步过) 往后翻页直到追上最新；按 id 去重，翻到没有新成交为止 (不依赖每页条数)。
+    币安按成交 id 翻，第一次同步从 fromId=0 开始；其余按时间翻，整页都落在同一毫秒时只能跳过这一毫秒剩下的成交 (记指标)"""
+    trades, seen = [], set()
+    by_id = TRADE_CURSORS.get(exchange.id) == 'fromId'
+    params = {'fromId': 0} if by_id and since is None else {}
+    since = SYNC_HISTORY_START if since is None else since
+    while cancel is None or not cancel.is_set():
+        page = exchange.fetch_my_trades(market, None if 'fromId' in params else since, SYNC_PAGE_LIMIT, params)
+        fresh = [t for t in page or [] if t['id'] not in seen]
+        if not fresh: break
+        trades.extend(fresh)
+        seen.update(t['id'] for t in fresh)
+        if by_id:
+            params = {'fromId': max(int(t['id']) for t in fresh) + 1}
+        else:
+            last = max(t['timestamp'] for t in fresh)
+            if last <= since:
+                metrics.inc("sync_page_overflow_total", venue=exchange.id)
+                last = since + 1
+            since = last
     return trades
 
-def sync_history_log(supabase_client, user_id, exchange_id, api_key, api_secret, password=None):
+def fetch_account_trades(exchange, since, cancel=None):
+    """整个账户 since (毫秒，None 表示从头) 之后的成交一次翻完，按交易对分好返回 {交易对: [成交]}。
+    给 Kraken 用: 它的成交记录本来就不分交易对，按交易对查只是 ccxt 在本地过滤，偏移量会按过滤后的条数走错，
+    每个交易对还要把全账户翻一遍。start 自己放进 params (ccxt 不再按 since 过滤)，偏移量按交易所原始页长推进"""
+    by_market, seen, ofs = {}, set(), 0
+    params = {} if since is None else {'start': since // 1000}
+    while cancel is None or not cancel.is_set():
+        page = exchange.fetch_my_trades(None, None, None, dict(params, ofs=ofs))
+        if not page: break
+        ofs += len(page)
+        for t in page:
+            if t['id'] in seen: continue
+            seen.add(t['id'])
+            by_market.setdefault(t['symbol'], []).append(t)
+    return by_market
+
+def sync_history_log(supabase_client, user_id, exchange_id, api_key, api_secret, password=None, job=None):
     try:
-        exchange_class = getattr(ccxt, exchange_id)
-        config = {'apiKey': api_key, 'secret': api_secret, 'enableRateLimit': True, 'options': {'defaultType': 'spot'}}
-        if password: config['password'] = password
-        exchange = exchange_class(config)
-        balance = exchange.fetch_balance()
-        assets = [coin for coin, amt in balance['total'].items() if amt > 0]
-        synced_count = 0
-        for coin in assets:
-            if coin in ['USD', 'USDT', 'USDC']: continue
-            trades = []
-            search_list = [f"{coin}/USDT", f"{coin}/USD", f"{coin}/USDC", f"{coin}/BTC", f"{coin}/ETH"]
-            for symbol in search_list:
+        with get_client_pool().lease(exchange_id, api_key, api_secret, password) as exchange:
+            balance = exchange.fetch_balance()
+            assets = [coin for coin, amt in balance['total'].items() if amt and amt > 0]
+            # 只查交易所真实存在的交易对，不再靠异常试错
+            markets = load_markets_cached(exchange)
+            candidates = [f"{coin}/{q}" for coin in assets if coin not in ['USD', 'USDT', 'USDC'] for q in SYNC_QUOTES]
+            candidates = [m for m in candidates if m in markets]
+
+            # 逐个交易对翻页，限速交给 ccxt 自己 (按每个接口的权重排队)；
+            # 同一个账户的私有接口共用一份额度，多线程翻页在同一个限速器后面也快不了，所以不开线程池
+            marks = load_sync_watermarks(supabase_client, user_id, exchange_id)
+            cancel = job.cancel_event if job is not None else None
+            if job is not None: job.progress.update(markets_total=len(candidates), markets_done=0, trades_written=0)
+            results, failed = {}, []
+            if TRADE_CURSORS.get(exchange.id) == 'ofs':
+                # 全账户翻一遍，从所有交易对里最旧的水位开始；有没同步过的就从头
+                known = [marks[m] for m in candidates if m in marks]
+                since = min(known) if known and len(known) == len(candidates) else None
                 try:
-                    t = exchange.fetch_my_trades(symbol, limit=50)
-                    if t: trades.extend(t)
-                except: continue
-            seen = set(); unique_trades = []
+                    trades_by_market = fetch_account_trades(exchange, since, cancel)
+                    results = {m: trades for m, trades in trades_by_market.items() if m in markets}
+                except Exception as e:
+                    metrics.error(f"sync_market:{exchange_id}", e)
+                    failed = list(candidates)
+                if job is not None: job.progress['markets_done'] = len(candidates)
+            else:
+                for m in candidates:
+                    if cancel is not None and cancel.is_set(): break
+                    try: results[m] = fetch_market_trades(exchange, m, marks.get(m), cancel)
+                    except Exception as e:
+                        metrics.error(f"sync_market:{exchange_id}", e)
+                        failed.append(m)
+                    if job is not None: job.progress['markets_done'] += 1
+            # 取消发生在写库之前，水位不动，下次从头接着同步
+            if cancel is not None and cancel.is_set(): return False, "Cancelled"
+            special_trades = fetch_special_converts(exchange, exchange_id)
+            # 账本里的兑换记录没有价格，按成交时刻的历史 K 线一次补齐
+            backfill_prices(exchange, special_trades)
+
+        rows = []
+        new_marks = {}
+        for market, trades in results.items():
+            if not trades: continue
+            coin = markets[market]['base']
             for t in trades:
-                if t['id'] not in seen: unique_trades.append(t); seen.add(t['id'])
-            for t in unique_trades:
                 ts = datetime.datetime.fromtimestamp(t['timestamp']/1000.0)
-                data = {"user_id": user_id, "exchange": exchange_id, "symbol": coin, "type": 'BUY' if t['side']=='buy' else 'SELL', "quantity": float(t['amount']), "price": float(t['price']), "fee": 0, "timestamp": ts.isoformat(), "trade_id": str(t['id'])}
-                supabase_client.table("transactions").upsert(data, on_conflict="user_id, exchange, trade_id").execute()
-                synced_count += 1
-            recalculate_single_asset(supabase_client, user_id, coin)
+                rows.append({"user_id": user_id, "exchange": exchange_id, "symbol": coin, "type": 'BUY' if t['side']=='buy' else 'SELL', "quantity": float(t['amount']), "price": float(t['price']), "fee": 0, "timestamp": ts.isoformat(), "trade_id": str(t['id'])})
+            new_marks[market] = max(t['timestamp'] for t in trades)
         
-        special_trades = fetch_special_converts(exchange, exchange_id)
+        unpriced = 0
         for t in special_trades:
-            if t['price'] > 0:
-                data = {"user_id": user_id, "exchange": exchange_id, "symbol": t['symbol'], "type": t['side'], "quantity": t['amount'], "price": t['price'], "timestamp": t['timestamp'].isoformat(), "trade_id": t['id']}
-                supabase_client.table("transactions").upsert(data, on_conflict="user_id, exchange, trade_id").execute()
-                synced_count += 1
-                recalculate_single_asset(supabase_client, user_id, t['symbol'])
-        return True, f"Synced {synced_count} records!"
-    except Exception as e: return False, f"Error: {str(e)}"
+            if not t['price'] > 0:
+                unpriced += 1
+            else:
+                rows.append({"user_id": user_id, "exchange": exchange_id, "symbol": t['symbol'], "type": t['side'], "quantity": t['amount'], "price": t['price'], "fee": 0, "timestamp": t['timestamp'].isoformat(), "trade_id": t['id']})
+
+        # 所有成交分块批量写入，然后对涉及的币种统一重算一次成本价
+        synced_count = upsert_transactions_bulk(supabase_client, rows, job)
+        recalculate_assets(supabase_client, user_id, [r['symbol'] for r in rows])
+        # 成交都写进去之后才推进水位，中途失败下次会从旧水位重来 (upsert 去重)
+        save_sync_watermarks(supabase_client, user_id, exchange_id, new_marks)
+        msg = f"Synced {synced_count} records from {len(candidates)} markets!"
+        if failed: msg += f" ({len(failed)} markets failed: {', '.join(failed[:5])})"
+        if unpriced: msg += f" ({unpriced} converts skipped: no historical price)"
+        return True, msg
+    except Exception as e:
+        metrics.error("sync_history_log", e)
+        return False, f"Error: {str(e)}"
+
+# ==========================================
+# 6. 税务计算 (NumPy 列式配对引擎)
+# ==========================================
+LOT_METHODS = ('FIFO', 'LIFO', 'HIFO')
+LOT_DUST = 0.00000001   # 剩余量低于此值的批次视为已清空
+NS_PER_DAY = 86400 * 10**9
+
+def _clip_sells(qty, is_buy):
+    """卖出量超过当时持仓的部分直接作废 (与逐行配对一致)，返回每行实际可配对的卖出量"""
+    cum = np.cumsum(np.where(is_buy, qty, -qty))
+    # 截断于 0 的累计持仓: inv_k = C_k - min(0, min(C_0..C_k))
+    inv = cum - np.minimum(np.minimum.accumulate(cum), 0.0)
+    prev = np.concatenate(([0.0], inv[:-1]))
+    return np.where(is_buy, 0.0, prev - inv)
+
+def _match_fifo(qty, is_buy):
+    """FIFO: 买入与卖出累计量区间求交，一次 searchsorted 完成全部配对"""
+    sell_qty = _clip_sells(qty, is_buy)
+    buy_rows = np.flatnonzero(is_buy)
+    sell_rows = np.flatnonzero(sell_qty > 0)
+    if not len(buy_rows) or not len(sell_rows):
+        return np.empty(0, np.int64), np.empty(0, np.int64), np.empty(0)
+    b_cum = np.cumsum(qty[buy_rows])
+    s_cum = np.cumsum(sell_qty[sell_rows])
+    edges = np.union1d(b_cum, s_cum)
+    edges = edges[edges <= s_cum[-1]]
+    lo = np.concatenate(([0.0], edges[:-1]))
+    matched = edges - lo
+    # 累计和的浮点残差会切出极小区间，按量级过滤掉
+    keep = matched > np.spacing(max(b_cum[-1], 1.0)) * 64
+    mid = (lo + edges)[keep] / 2
+    b = np.minimum(np.searchsorted(b_cum, mid), len(buy_rows) - 1)
+    s = np.minimum(np.searchsorted(s_cum, mid), len(sell_rows) - 1)
+    return sell_rows[s], buy_rows[b], matched[keep]
+
+def _match_ordered(qty, price, is_buy, method):
+    """LIFO / HIFO: 栈或堆维护未平仓批次，整体 O(n log n)"""
+    remaining = qty.tolist()
+    prices = price.tolist()
+    lots = []
+    out_s, out_b, out_q = [], [], []
+    for i, buy in enumerate(is_buy.tolist()):
+        if buy:
+            if method == 'HIFO': heapq.heappush(lots, (-prices[i], i))
+            else: lots.append(i)
+            continue
+        qty_to_sell = remaining[i]
+        while qty_to_sell > 0 and lots:
+            b = lots[0][1] if method == 'HIFO' else lots[-1]
+            matched = min(qty_to_sell, remaining[b])
+            out_s.append(i); out_b.append(b); out_q.append(matched)
+            qty_to_sell -= matched
+            remaining[b] -= matched
+            if remaining[b] <= LOT_DUST:
+                if method == 'HIFO': heapq.heappop(lots)
+                else: lots.pop()
+    return np.array(out_s, np.int64), np.array(out_b, np.int64), np.array(out_q, float)
+
+def match_lots(qty, price, is_buy, method='FIFO'):
+    """单一币种、已按时间排序的列式数组 -> (卖出行, 买入行, 配对数量)"""
+    if method == 'FIFO': return _match_fifo(qty, is_buy)
+    return _match_ordered(qty, price, is_buy, method)
+
+LOT_COLUMNS = ('qty', 'price', 'ts', 'day')
+
+def _prepare_ledger(df):
+    """过滤 BUY/SELL，按币种、再按时间稳定排序，返回 (币种, 列式数组, 每个币种的切片)"""
+    df = df[df['type'].isin(['BUY', 'SELL'])]
+    ts = pd.to_datetime(df['timestamp'], format='mixed')
+    ts_ns = ts.values.astype('datetime64[ns]').view('int64')
+    # 日期按本地时区的挂钟时间取日，与 Timestamp.strftime 一致
+    wall = ts.dt.tz_localize(None) if ts.dt.tz is not None else ts
+    codes, symbols = pd.factorize(df['symbol'], sort=True)
+    order = np.lexsort((ts_ns, codes))
+    cols = {
+        'qty': df['quantity'].to_numpy(float)[order],
+        'price': df['price'].to_numpy(float)[order],
+        'ts': ts_ns[order],
+        'day': wall.values[order].astype('datetime64[D]'),
+        'is_buy': (df['type'].to_numpy() == 'BUY')[order],
+    }
+    codes = codes[order]
+    bounds = np.flatnonzero(np.diff(codes)) + 1
+    starts = np.concatenate(([0], bounds)); ends = np.concatenate((bounds, [len(codes)]))
+    return list(symbols), cols, list(zip(starts.tolist(), ends.tolist()))
+
+def _match_segment(cols, method, lots=None):
+    """在已有未平仓批次 lots 之后续接一段成交并配对，返回 (合并后的列, 卖出行, 买入行, 配对数量, 新的未平仓批次)"""
+    if lots is not None and len(lots['qty']):
+        opened = {'is_buy': np.ones(len(lots['qty']), bool), **lots}
+        cols = {k: np.concatenate((opened[k], cols[k])) for k in opened}
+    qty, price, is_buy = cols['qty'], cols['price'], cols['is_buy']
+    s, b, m = match_lots(qty, price, is_buy, method)
+
+    remaining = np.where(is_buy, qty, 0.0) - np.bincount(b, weights=m, minlength=len(qty))
+    still_open = is_buy & (remaining > LOT_DUST)
+    new_lots = {k: cols[k][still_open] for k in LOT_COLUMNS}
+    new_lots['qty'] = remaining[still_open]
+    return cols, s, b, m, new_lots
+
+def _settle(symbol, cols, method, lots=None):
+    """在已有未平仓批次 lots 之后续接一段成交，返回 (已实现盈亏, 税务事件, 新的未平仓批次)"""
+    cols, s, b, m, new_lots = _match_segment(cols, method, lots)
+    if not len(m): return 0.0, [], new_lots
+
+    price = cols['price']
+    gain = m * price[s] - m * price[b]
+    days = (cols['ts'][s] - cols['ts'][b]) // NS_PER_DAY
+    term = np.where(days > 365, "LONG", "SHORT")
+    dates = np.datetime_as_string(cols['day'][s])
+    events = [{'symbol': symbol, 'qty': q, 'gain': g, 'term': t, 'date': d}
+              for q, g, t, d in zip(m.tolist(), gain.tolist(), term.tolist(), dates.tolist())]
+    return float(gain.sum()), events, new_lots
 
 class TaxCalculator:
+    def __init__(self, method='FIFO'):
+        method = method.upper()
+        if method not in LOT_METHODS: raise ValueError(f"Unsupported lot method: {method}")
+        self.method = method
+
+    @metrics.timed("tax_compute_seconds", mode="full")
     def calculate(self, df):
         if df.empty: return 0, []
-        df['timestamp'] = pd.to_datetime(df['timestamp'], format='mixed')
-        df = df.sort_values('timestamp')
+        symbols, cols, slices = _prepare_ledger(df)
         realized_pnl = 0.0
         tax_events = []
-        for symbol, group in df.groupby('symbol'):
-            queue = deque()
-            for _, row in group.iterrows():
-                if row['type'] == 'BUY':
-                    queue.append({'qty': float(row['quantity']), 'price': float(row['price']), 'date': row['timestamp']})
-                elif row['type'] == 'SELL':
-                    qty_to_sell = float(row['quantity'])
-                    sell_price = float(row['price'])
-                    while qty_to_sell > 0 and queue:
-                        buy_lot = queue[0]
-                        matched = min(qty_to_sell, buy_lot['qty'])
-                        cost = matched * buy_lot['price']
-                        gain = (matched * sell_price) - cost
-                        days = (row['timestamp'] - buy_lot['date']).days
-                        term = "LONG" if days > 365 else "SHORT"
-                        tax_events.append({'symbol': symbol, 'qty': matched, 'gain': gain, 'term': term, 'date': row['timestamp'].strftime('%Y-%m-%d')})
-                        realized_pnl += gain
-                        qty_to_sell -= matched
-                        buy_lot['qty'] -= matched
-                        if buy_lot['qty'] <= 0.00000001: queue.popleft()
-        return realized_pnl, tax_events
\ No newline at end of file
+        for symbol, (start, end) in zip(symbols, slices):
+            gain, events, _ = _settle(symbol, {k: v[start:end] for k, v in cols.items()}, self.method)
+            realized_pnl += gain
+            tax_events.extend(events)
+        return realized_pnl, tax_events
+
+    @metrics.timed("tax_compute_seconds", mode="incremental")
+    def refresh(self, supabase, user_id):
+        """增量版 calculate: 只处理检查点之后的新成交，返回值与 calculate 相同"""
+        book = get_tax_checkpoints().book(user_id, self.method)
+        with book.lock:
+            book.sync(supabase, user_id)
+            return book.summary()
+
+# --- 年度报表 (Form 8949 格式): 分块读账本、边配对边写文件，内存只和块大小及未平仓批次数有关 ---
+REPORT_CHUNK = DB_PAGE
+REPORT_COLUMNS = ['description', 'symbol', 'quantity', 'date_acquired', 'date_sold', 'proceeds', 'cost_basis', 'gain', 'term']
+
+def iter_transactions(supabase, user_id, chunk=REPORT_CHUNK):
+    """按 (币种, 时间, id) 顺序分页读出全部成交，每次一个 DataFrame"""
+    build = lambda: (supabase.table("transactions").select("id, symbol, type, quantity, price, timestamp")
+                     .eq("user_id", user_id).in_("type", ["BUY", "SELL"]))
+    for rows in iter_pages(build, ('symbol', 'timestamp', 'id'), chunk):
+        yield pd.DataFrame(rows)
+
+def _report_rows(symbol, cols, s, b, m):
+    proceeds = m * cols['price'][s]
+    cost = m * cols['price'][b]
+    days = (cols['ts'][s] - cols['ts'][b]) // NS_PER_DAY
+    return pd.DataFrame({
+        'description': [f"{q:.8g} {symbol}" for q in m.tolist()],
+        'symbol': symbol,
+        'quantity': m,
+        'date_acquired': np.datetime_as_string(cols['day'][b]),
+        'date_sold': np.datetime_as_string(cols['day'][s]),
+        'proceeds': proceeds.round(2),
+        'cost_basis': cost.round(2),
+        'gain': (proceeds - cost).round(2),
+        'term': np.where(days > 365, "LONG", "SHORT"),
+    }, columns=REPORT_COLUMNS)
+
+def iter_tax_lots(frames, method='FIFO', year=None):
+    """逐块配对，每块产出一个 8949 明细 DataFrame (可能为空)。
+    frames 必须按币种分组、组内按时间排好 (iter_transactions 的顺序)，同一币种可以跨块；
+    year 只筛卖出日期，之前的成交照样参与配对"""
+    method = method.upper()
+    open_lots = {}
+    for df in frames:
+        if df.empty: continue
+        symbols, cols, slices = _prepare_ledger(df)
+        out = []
+        for symbol, (start, end) in zip(symbols, slices):
+            seg, s, b, m, open_lots[symbol] = _match_segment({k: v[start:end] for k, v in cols.items()}, method, open_lots.get(symbol))
+            if year is not None and len(s):
+                in_year = seg['day'][s].astype('datetime64[Y]').astype(int) + 1970 == year
+                s, b, m = s[in_year], b[in_year], m[in_year]
+            if len(m): out.append(_report_rows(symbol, seg, s, b, m))
+        # 按币种分组读入: 只有这一块最后一行的币种可能延续到下一块，其余币种的未平仓批次可以丢掉
+        carry = df['symbol'].iloc[-1]
+        open_lots = {carry: open_lots[carry]} if carry in open_lots else {}
+        yield pd.concat(out, ignore_index=True) if out else pd.DataFrame(columns=REPORT_COLUMNS)
+
+def write_tax_report(frames, out, fmt='csv', method='FIFO', year=None):
+    """把 iter_tax_lots 的结果逐块写到 out (路径或二进制文件对象)，返回写了多少行。
+    Parquet 每块一个 row group，需要 pyarrow"""
+    written = 0
+    if fmt == 'parquet':
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        writer = None
+        try:
+            for chunk in iter_tax_lots(frames, method, year):
+                if chunk.empty: continue
+                table = pa.Table.from_pandas(chunk, preserve_index=False)
+                if writer is None: writer = pq.ParquetWriter(out, table.schema)
+                writer.write_table(table)
+                written += len(chunk)
+            if writer is None:
+                pq.write_table(pa.Table.from_pandas(pd.DataFrame(columns=REPORT_COLUMNS), preserve_index=False), out)
+        finally:
+            if writer is not None: writer.close()
+        return written
+    f = open(out, 'w', newline='') if isinstance(out, (str, os.PathLike)) else io.TextIOWrapper(out, newline='', write_through=True)
+    try:
+        f.write(','.join(REPORT_COLUMNS) + '\n')
+        for chunk in iter_tax_lots(frames, method, year):
+            chunk.to_csv(f, header=False, index=False)
+            written += len(chunk)
+    finally:
+        if isinstance(out, (str, os.PathLike)): f.close()
+        else: f.detach()
+    return written
+
+def export_tax_report(supabase, user_id, out, fmt='csv', method='FIFO', year=None):
+    """直接从数据库生成报表，不需要界面"""
+    return write_tax_report(iter_transactions(supabase, user_id), out, fmt, method, year)
+
+# ==========================================
+# 7. 增量税务检查点
+# ==========================================
+TAX_CHECKPOINT_MAX_AGE = 3600   # 检查点最多用多久就整体重建 (兜底别的进程原地改了成交，行数和最大 id 都不变)
+
+class TaxCheckpoint:
+    """单个币种的检查点: 未平仓批次 + 已实现盈亏 + 高水位 (最后成交时间)。
+    同一时刻的成交按 id 排序，新写入的 id 更大，时间等于高水位的新成交接在后面就和整体重放的顺序一致"""
+    def __init__(self):
+        self.lots = None
+        self.realized = 0.0
+        self.events = []
+        self.hwm_ts = np.iinfo(np.int64).min
+
+class TaxBook:
+    """一个用户在某种配对方法下的全部检查点。
+    transactions.id 是自增主键，last_id 之后的行就是上次以来新写入的成交。
+    读完新成交后核对 (行数, 最大 id): 本进程的删除会同步扣减 row_count，对不上就是别处删过或插过，整体重放"""
+    def __init__(self, method):
+        self.method = method
+        self.lock = threading.Lock()
+        self.symbols = {}
+        self.dirty = set()
+        self.last_id = None
+        self.row_count = 0
+        self.built_at = time.time()
+        self._summary = None
+
+    def reset(self):
+        self.symbols.clear(); self.dirty.clear()
+        self.last_id = None; self.row_count = 0; self._summary = None
+        self.built_at = time.time()
+
+    def invalidate(self, symbol, removed=0):
+        self.dirty.add(symbol)
+        self.row_count -= removed
+        self._summary = None
+
+    def sync(self, supabase, user_id):
+        if self.last_id is not None and time.time() - self.built_at > TAX_CHECKPOINT_MAX_AGE: self.reset()
+        new_df = get_transactions_since(supabase, user_id, self.last_id)
+        if self.last_id is not None:
+            # 先读新成交再核对: 别处删一条又插一条时行数不变，但加上新读到的就对不上了；
+            # 读完之后才插进来的，行数可能正好抵消，最大 id 也会对不上
+            count, max_id = ledger_fingerprint(supabase, user_id)
+            expected_max = int(new_df['id'].max()) if not new_df.empty else self.last_id
+            if count != self.row_count + len(new_df) or max_id != expected_max:
+                self.reset()
+                new_df = get_transactions_since(supabase, user_id)
+        if not new_df.empty:
+            self.last_id = int(new_df['id'].max())
+            self.row_count += len(new_df)
+            self._summary = None
+            symbols, cols, slices = _prepare_ledger(new_df)
+            for symbol, (start, end) in zip(symbols, slices):
+                if symbol in self.dirty: continue
+                chunk = {k: v[start:end] for k, v in cols.items()}
+                cp = self.symbols.get(symbol)
+                if cp is None: cp = self.symbols[symbol] = TaxCheckpoint()
+                # 时间早于高水位的插入会改变之前的配对，只重放这个币种
+                elif chunk['ts'][0] < cp.hwm_ts:
+                    self.dirty.add(symbol); continue
+                self._advance(cp, symbol, chunk)
+        for symbol in list(self.dirty):
+            self._replay(supabase, user_id, symbol)
+
+    def _advance(self, cp, symbol, chunk):
+        gain, events, cp.lots = _settle(symbol, chunk, self.method, cp.lots)
+        cp.realized += gain
+        cp.events.extend(events)
+        cp.hwm_ts = int(chunk['ts'][-1])
+
+    def _replay(self, supabase, user_id, symbol):
+        df = get_transaction_history(supabase, user_id, symbol)
+        self.dirty.discard(symbol)
+        self.symbols.pop(symbol, None)
+        self._summary = None
+        if df.empty: return
+        symbols, cols, slices = _prepare_ledger(df)
+        if not symbols: return
+        cp = self.symbols[symbol] = TaxCheckpoint()
+        self._advance(cp, symbol, cols)
+
+    def summary(self):
+        if self._summary is None:
+            realized_pnl = 0.0
+            tax_events = []
+            for symbol in sorted(self.symbols):
+                realized_pnl += self.symbols[symbol].realized
+                tax_events.extend(self.symbols[symbol].events)
+            self._summary = (realized_pnl, tax_events)
+        return self._summary
+
+class TaxCheckpointStore:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.books = {}
+
+    def book(self, user_id, method):
+        with self.lock:
+            key = (user_id, method)
+            if key not in self.books: self.books[key] = TaxBook(method)
+            return self.books[key]
+
+    def updated(self, rows):
+        """upsert 返回的行里 id 不超过检查点 last_id 的是原地更新，对应币种下次重放"""
+        with self.lock:
+            books = [(uid, b) for (uid, _), b in self.books.items()]
+        for uid, book in books:
+            with book.lock:
+                if book.last_id is None: continue
+                for r in rows:
+                    if r.get('user_id') == uid and r.get('id') is not None and int(r['id']) <= book.last_id:
+                        book.invalidate(r['symbol'])
+
+    def invalidate(self, user_id, symbol=None, removed=0):
+        """symbol 为空表示整个用户的账本失效"""
+        with self.lock:
+            books = [b for (uid, _), b in self.books.items() if uid == user_id]
+        for book in books:
+            with book.lock:
+                if symbol is None: book.reset()
+                else: book.invalidate(symbol, removed)
+
+@st.cache_resource
+def get_tax_checkpoints():
+    return TaxCheckpointStore()
+
+
+# ==========================================
+# 8. 后台同步任务
+# ==========================================
+SYNC_JOB_WORKERS = 4       # 全进程同时跑几个同步任务 (每个任务内部按交易对顺序翻页)
+SYNC_JOB_RETENTION = 600   # 跑完的任务保留多久供界面显示
+
+class SyncJob:
+    """一个同步任务: 状态、进度计数和取消标志，界面轮询读取，不会被阻塞"""
+    def __init__(self, key, kind):
+        self.key = key
+        self.kind = kind
+        self.status = "queued"   # queued / running / done / failed / cancelled
+        self.message = ""
+        self.progress = {}
+        self.cancel_event = threading.Event()
+        self.created_at = time.time()
+        self.finished_at = None
+        self.future = None
+
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    @property
+    def active(self):
+        return self.status in ("queued", "running")
+
+class JobRunner:
+    """进程级同步任务池: 按 (user_id, exchange, kind) 去重，支持取消和进度查询"""
+    def __init__(self, max_workers=SYNC_JOB_WORKERS):
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="sync-job")
+        self.lock = threading.Lock()
+        self.jobs = {}
+
+    def submit(self, key, kind, fn, *args, **kwargs):
+        """同一个 key 已经在排队或运行时直接返回那个任务，不重复提交"""
+        with self.lock:
+            self._prune()
+            job = self.jobs.get(key)
+            if job is not None and job.active: return job
+            job = self.jobs[key] = SyncJob(key, kind)
+            job.future = self.pool.submit(self._run, job, fn, args, kwargs)
+            return job
+
+    def _run(self, job, fn, args, kwargs):
+        if job.cancelled():
+            job.status, job.message, job.finished_at = "cancelled", "Cancelled", time.time()
+            return
+        job.status = "running"
+        try:
+            ok, msg = fn(*args, job=job, **kwargs)
+            if job.cancelled(): job.status = "cancelled"
+            else: job.status = "done" if ok else "failed"
+            job.message = msg
+        except Exception as e:
+            job.status, job.message = "failed", str(e)
+        job.finished_at = time.time()
+
+    def cancel(self, key):
+        with self.lock:
+            job = self.jobs.get(key)
+        if job is not None and job.active: job.cancel_event.set()
+        return job
+
+    def jobs_for(self, user_id):
+        with self.lock:
+            self._prune()
+            return [j for k, j in self.jobs.items() if k[0] == user_id]
+
+    def _prune(self):
+        now = time.time()
+        for key in [k for k, j in self.jobs.items() if j.finished_at and now - j.finished_at > SYNC_JOB_RETENTION]:
+            del self.jobs[key]
+
+@st.cache_resource
+def get_job_runner():
+    return JobRunner()
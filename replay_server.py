@@ -0,0 +1,132 @@
+"""
+本地行情回放服务器 (Kraken WebSocket v2 ticker 协议的替身)
+
+录制:  python replay_server.py record tickers.jsonl --symbols BTC/USD ETH/USD --seconds 300
+回放:  python replay_server.py serve tickers.jsonl --port 8765 --speed 10 --loop
+然后:  PRICE_FEED=stream PRICE_STREAM_URL=ws://127.0.0.1:8765 streamlit run app.py
+
+录制文件每行一条: {"t": 接收时间(毫秒), "msg": 原始消息}
+--speed 0 表示不按原始节奏，尽可能快地推送 (测吞吐)。
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import time
+
+import websockets
+
+KRAKEN_WS_URL = "wss://ws.kraken.com/v2"
+
+
+# ==========================================
+# 1. 录制
+# ==========================================
+async def record(path, symbols, seconds, url=KRAKEN_WS_URL):
+    count = 0
+    deadline = time.time() + seconds
+    async with websockets.connect(url) as ws:
+        await ws.send(json.dumps({"method": "subscribe", "params": {"channel": "ticker", "symbol": symbols}}))
+        with open(path, "w") as f:
+            while time.time() < deadline:
+                try:
+                    raw = await asyncio.wait_for(ws.recv(), timeout=max(deadline - time.time(), 0.1))
+                except asyncio.TimeoutError:
+                    break
+                msg = json.loads(raw)
+                if msg.get("channel") != "ticker": continue
+                f.write(json.dumps({"t": int(time.time() * 1000), "msg": msg}) + "\n")
+                count += 1
+    print(f"recorded {count} ticker messages -> {path}")
+
+
+# ==========================================
+# 2. 回放
+# ==========================================
+def load_recording(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+async def _heartbeat(ws):
+    while True:
+        await ws.send(json.dumps({"channel": "heartbeat"}))
+        await asyncio.sleep(1)
+
+
+async def _read_subscriptions(ws, subscribed):
+    """处理订阅和退订，每个交易对回一条确认 (和 Kraken 一样)；退订的交易对之后不再推送"""
+    async for raw in ws:
+        req = json.loads(raw)
+        method = req.get("method")
+        if method not in ("subscribe", "unsubscribe"): continue
+        params = req.get("params", {})
+        for s in params.get("symbol", []):
+            if method == "subscribe": subscribed.add(s)
+            else: subscribed.discard(s)
+            await ws.send(json.dumps({"method": method, "result": {"channel": params.get("channel"), "symbol": s}, "success": True}))
+
+
+async def _play(ws, records, subscribed, speed, loop):
+    sent = 0
+    started = time.time()
+    while True:
+        prev_t = None
+        for rec in records:
+            if speed > 0 and prev_t is not None:
+                await asyncio.sleep(max(rec["t"] - prev_t, 0) / 1000 / speed)
+            prev_t = rec["t"]
+            msg = rec["msg"]
+            data = [dict(item) for item in msg.get("data", []) if item.get("symbol") in subscribed]
+            if not data: continue
+            now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+            for item in data: item["timestamp"] = now
+            await ws.send(json.dumps({"channel": "ticker", "type": msg.get("type", "update"), "data": data}))
+            sent += 1
+            if speed <= 0 and sent % 1000 == 0: await asyncio.sleep(0)
+        if not loop: break
+    return sent, time.time() - started
+
+
+async def serve(path, host, port, speed, loop):
+    records = load_recording(path)
+    print(f"loaded {len(records)} messages from {path}, serving on ws://{host}:{port}")
+
+    async def handler(ws):
+        subscribed = set()
+        await ws.send(json.dumps({"channel": "status", "type": "update", "data": [{"system": "online", "api_version": "v2"}]}))
+        reader = asyncio.create_task(_read_subscriptions(ws, subscribed))
+        beat = asyncio.create_task(_heartbeat(ws))
+        try:
+            # 等客户端订阅后再开始回放
+            while not subscribed: await asyncio.sleep(0.05)
+            sent, elapsed = await _play(ws, records, subscribed, speed, loop)
+            print(f"{ws.remote_address}: sent {sent} messages in {elapsed:.2f}s ({sent / max(elapsed, 1e-9):,.0f} msg/s)")
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            reader.cancel(); beat.cancel()
+        # 不循环时播完就断开，正好用来验证客户端回退到轮询
+
+    async with websockets.serve(handler, host, port):
+        await asyncio.Future()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Record / replay Kraken v2 ticker streams")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p_rec = sub.add_parser("record")
+    p_rec.add_argument("path")
+    p_rec.add_argument("--symbols", nargs="+", default=["BTC/USD", "ETH/USD", "SOL/USD"])
+    p_rec.add_argument("--seconds", type=float, default=60)
+    p_rec.add_argument("--url", default=KRAKEN_WS_URL)
+    p_srv = sub.add_parser("serve")
+    p_srv.add_argument("path")
+    p_srv.add_argument("--host", default="127.0.0.1")
+    p_srv.add_argument("--port", type=int, default=8765)
+    p_srv.add_argument("--speed", type=float, default=1.0)
+    p_srv.add_argument("--loop", action="store_true")
+    args = parser.parse_args()
+
+    if args.cmd == "record": asyncio.run(record(args.path, args.symbols, args.seconds, args.url))
+    else: asyncio.run(serve(args.path, args.host, args.port, args.speed, args.loop))
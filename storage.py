@@ -0,0 +1,315 @@
+"""
+本地存储后端: 用 SQLite 实现 price_engine 用到的那部分 Supabase 查询接口
+(table().select().eq()...execute()，结果带 .data / .count)，price_engine 的数据函数不用改就能跑在本地库上。
+
+单机部署:  STORAGE_BACKEND=sqlite SQLITE_PATH=crypto_quant.db streamlit run app.py   (登录仍走 Supabase Auth)
+测试/压测: SQLiteStore(":memory:") 直接当 supabase 参数传给 price_engine 的函数
+"""
+import contextlib
+import os
+import re
+import sqlite3
+import threading
+
+# Supabase 上的对应表结构 (新增的表和索引) 在 supabase/migrations/ 里
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS user_portfolios (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT NOT NULL,
+    symbol TEXT NOT NULL,
+    amount REAL DEFAULT 0,
+    avg_buy_price REAL DEFAULT 0,
+    UNIQUE (user_id, symbol)
+);
+CREATE TABLE IF NOT EXISTS user_settings (
+    user_id TEXT PRIMARY KEY,
+    net_worth_goal REAL
+);
+CREATE TABLE IF NOT EXISTS transactions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT NOT NULL,
+    exchange TEXT,
+    symbol TEXT NOT NULL,
+    type TEXT NOT NULL,
+    quantity REAL,
+    price REAL,
+    fee REAL DEFAULT 0,
+    timestamp TEXT,
+    trade_id TEXT
+);
+CREATE UNIQUE INDEX IF NOT EXISTS transactions_trade ON transactions (user_id, exchange, trade_id);
+CREATE INDEX IF NOT EXISTS transactions_user_symbol_ts ON transactions (user_id, symbol, timestamp, id);
+CREATE INDEX IF NOT EXISTS transactions_user_ts ON transactions (user_id, timestamp, id);
+CREATE TABLE IF NOT EXISTS cost_basis (
+    user_id TEXT NOT NULL,
+    symbol TEXT NOT NULL,
+    total_cost REAL DEFAULT 0,
+    total_qty REAL DEFAULT 0,
+    PRIMARY KEY (user_id, symbol)
+);
+CREATE TABLE IF NOT EXISTS sync_watermarks (
+    user_id TEXT NOT NULL,
+    exchange TEXT NOT NULL,
+    market TEXT NOT NULL,
+    last_ts INTEGER,
+    PRIMARY KEY (user_id, exchange, market)
+);
+CREATE TABLE IF NOT EXISTS user_snapshots (
+    user_id TEXT NOT NULL,
+    as_of TEXT NOT NULL,
+    net_worth REAL,
+    cost REAL,
+    pnl REAL,
+    pnl_pct REAL,
+    positions INTEGER,
+    realized_pnl REAL,
+    tax_events INTEGER,
+    net_worth_goal REAL,
+    goal_pct REAL,
+    computed_at TEXT,
+    PRIMARY KEY (user_id, as_of)
+);
+"""
+
+# upsert 不带 on_conflict 时按主键冲突 (和 PostgREST 一致)
+PRIMARY_KEYS = {
+    'user_portfolios': ('id',),
+    'user_settings': ('user_id',),
+    'transactions': ('id',),
+    'cost_basis': ('user_id', 'symbol'),
+    'sync_watermarks': ('user_id', 'exchange', 'market'),
+    'user_snapshots': ('user_id', 'as_of'),
+}
+
+_IDENT = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+def _ident(name):
+    name = name.strip()
+    if not _IDENT.match(name): raise ValueError(f"Invalid identifier: {name!r}")
+    return f'"{name}"'
+
+_OPS = {'eq': '=', 'neq': '!=', 'gt': '>', 'gte': '>=', 'lt': '<', 'lte': '<='}
+
+def _split_top(text):
+    """按顶层逗号切开 (括号和双引号里的逗号不算)"""
+    parts, buf, depth, quoted, escaped = [], [], 0, False, False
+    for ch in text:
+        if quoted:
+            if escaped: escaped = False
+            elif ch == '\\': escaped = True
+            elif ch == '"': quoted = False
+        elif ch == '"': quoted = True
+        elif ch == '(': depth += 1
+        elif ch == ')': depth -= 1
+        elif ch == ',' and depth == 0:
+            parts.append(''.join(buf)); buf = []
+            continue
+        buf.append(ch)
+    parts.append(''.join(buf))
+    return parts
+
+def _logic(text, joiner):
+    """PostgREST 逻辑条件 (a.gt.1,and(b.eq."x",c.lt.2)) -> 参数化 SQL"""
+    sqls, params = [], []
+    for part in map(str.strip, _split_top(text)):
+        nested = re.match(r'^(and|or)\((.*)\)$', part, re.S)
+        if nested:
+            sql, p = _logic(nested.group(2), nested.group(1).upper())
+        else:
+            column, op, value = part.split('.', 2)
+            if op not in _OPS: raise ValueError(f"Unsupported operator: {op}")
+            if len(value) >= 2 and value[0] == value[-1] == '"': value = re.sub(r'\\(.)', r'\1', value[1:-1])
+            sql, p = f"{_ident(column)} {_OPS[op]} ?", [value]
+        sqls.append(sql); params.extend(p)
+    return "(" + f" {joiner} ".join(sqls) + ")", params
+
+
+class Result:
+    def __init__(self, data, count=None):
+        self.data = data
+        self.count = count
+
+
+class Query:
+    """PostgREST 查询构造器的子集: 过滤条件拼成参数化的 WHERE，execute 时一次执行"""
+    def __init__(self, store, table):
+        self.store = store
+        self.table = _ident(table)
+        self.name = table
+        self.op = 'select'
+        self.columns = '*'
+        self.count = None
+        self.head = False
+        self.where = []
+        self.params = []
+        self.orders = []
+        self.limit_n = None
+        self.offset_n = 0
+        self.payload = None
+        self.conflict = None
+        self.ignore_duplicates = False
+
+    # --- 操作 ---
+    def select(self, columns="*", count=None, head=False):
+        self.op, self.columns, self.count, self.head = 'select', columns, count, head
+        return self
+
+    def insert(self, rows):
+        self.op, self.payload = 'insert', rows
+        return self
+
+    def upsert(self, rows, on_conflict=None, ignore_duplicates=False):
+        self.op, self.payload, self.ignore_duplicates = 'upsert', rows, ignore_duplicates
+        self.conflict = [c.strip() for c in on_conflict.split(',')] if on_conflict else list(PRIMARY_KEYS.get(self.name, ('id',)))
+        return self
+
+    def update(self, values):
+        self.op, self.payload = 'update', values
+        return self
+
+    def delete(self):
+        self.op = 'delete'
+        return self
+
+    # --- 过滤 / 排序 / 分页 ---
+    def _filter(self, column, sql, value):
+        self.where.append(f"{_ident(column)} {sql}")
+        self.params.append(value)
+        return self
+
+    def eq(self, column, value): return self._filter(column, "= ?", value)
+    def neq(self, column, value): return self._filter(column, "!= ?", value)
+    def gt(self, column, value): return self._filter(column, "> ?", value)
+    def gte(self, column, value): return self._filter(column, ">= ?", value)
+    def lt(self, column, value): return self._filter(column, "< ?", value)
+    def lte(self, column, value): return self._filter(column, "<= ?", value)
+
+    def or_(self, filters):
+        """PostgREST 的 or=(...)，支持 col.op.value (值可加双引号) 和嵌套的 and(...)/or(...)"""
+        sql, params = _logic(filters, "OR")
+        self.where.append(sql)
+        self.params.extend(params)
+        return self
+
+    def in_(self, column, values):
+        values = list(values)
+        if not values:
+            self.where.append("0")
+            return self
+        self.where.append(f"{_ident(column)} IN ({', '.join('?' * len(values))})")
+        self.params.extend(values)
+        return self
+
+    def order(self, column, desc=False):
+        self.orders.append(f"{_ident(column)} {'DESC' if desc else 'ASC'}")
+        return self
+
+    def limit(self, n):
+        self.limit_n = n
+        return self
+
+    def range(self, start, end):
+        self.offset_n, self.limit_n = start, end - start + 1
+        return self
+
+    # --- 执行 ---
+    def _where_sql(self):
+        return f" WHERE {' AND '.join(self.where)}" if self.where else ""
+
+    def execute(self):
+        with self.store.lock:
+            return getattr(self, f"_{self.op}")(self.store.conn)
+
+    def _select(self, conn):
+        where = self._where_sql()
+        count = None
+        if self.count:
+            count = conn.execute(f"SELECT COUNT(*) FROM {self.table}{where}", self.params).fetchone()[0]
+        if self.head: return Result([], count)
+        cols = "*" if self.columns.strip() == "*" else ", ".join(map(_ident, self.columns.split(',')))
+        sql = f"SELECT {cols} FROM {self.table}{where}"
+        if self.orders: sql += " ORDER BY " + ", ".join(self.orders)
+        if self.limit_n is not None: sql += f" LIMIT {int(self.limit_n)} OFFSET {int(self.offset_n)}"
+        return Result([dict(r) for r in conn.execute(sql, self.params)], count)
+
+    def _rows(self):
+        return self.payload if isinstance(self.payload, list) else [self.payload]
+
+    def _insert(self, conn):
+        out = []
+        with self.store.transaction():
+            for row in self._rows():
+                cols = list(row)
+                sql = f"INSERT INTO {self.table} ({', '.join(map(_ident, cols))}) VALUES ({', '.join('?' * len(cols))}) RETURNING *"
+                out.extend(dict(r) for r in conn.execute(sql, [row[c] for c in cols]))
+        return Result(out)
+
+    def _upsert(self, conn):
+        out = []
+        target = ', '.join(map(_ident, self.conflict))
+        with self.store.transaction():
+            for row in self._rows():
+                cols = list(row)
+                sets = [c for c in cols if c not in self.conflict]
+                action = "DO NOTHING" if self.ignore_duplicates or not sets else \
+                         "DO UPDATE SET " + ", ".join(f"{_ident(c)} = excluded.{_ident(c)}" for c in sets)
+                sql = (f"INSERT INTO {self.table} ({', '.join(map(_ident, cols))}) VALUES ({', '.join('?' * len(cols))}) "
+                       f"ON CONFLICT ({target}) {action} RETURNING *")
+                out.extend(dict(r) for r in conn.execute(sql, [row[c] for c in cols]))
+        return Result(out)
+
+    def _update(self, conn):
+        cols = list(self.payload)
+        sql = f"UPDATE {self.table} SET {', '.join(f'{_ident(c)} = ?' for c in cols)}{self._where_sql()} RETURNING *"
+        with self.store.transaction():
+            return Result([dict(r) for r in conn.execute(sql, [self.payload[c] for c in cols] + self.params)])
+
+    def _delete(self, conn):
+        with self.store.transaction():
+            return Result([dict(r) for r in conn.execute(f"DELETE FROM {self.table}{self._where_sql()} RETURNING *", self.params)])
+
+
+class SQLiteStore:
+    """嵌入式存储: 一个连接 + 一把锁 (Streamlit 各会话线程和后台同步任务共用)，文件库开 WAL"""
+    def __init__(self, path=":memory:"):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        if path != ":memory:":
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+
+    def table(self, name):
+        return Query(self, name)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """整批写入一个事务 (调用方持锁)；连接是自动提交模式，这里显式 BEGIN/COMMIT"""
+        self.conn.execute("BEGIN")
+        try:
+            yield
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.conn.execute("COMMIT")
+
+    def close(self):
+        with self.lock: self.conn.close()
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+def get_sqlite_store(path):
+    """同一路径在进程内只开一个连接"""
+    with _stores_lock:
+        if path not in _stores: _stores[path] = SQLiteStore(path)
+        return _stores[path]
+
+def open_storage(supabase_client=None):
+    """按 STORAGE_BACKEND 选择数据后端: supabase (默认，直接用传入的客户端) 或 sqlite (SQLITE_PATH)"""
+    if os.environ.get("STORAGE_BACKEND", "supabase").lower() == "sqlite":
+        return get_sqlite_store(os.environ.get("SQLITE_PATH", "crypto_quant.db"))
+    return supabase_client
@@ -0,0 +1,57 @@
+-- cost_basis / sync_watermarks / user_snapshots 三张表，以及账本 keyset 分页用的索引。
+-- 主键就是代码里 upsert 的 on_conflict 列，缺了 PostgREST 会报 "no unique or exclusion constraint"。
+-- 本地 SQLite 后端的等价定义见 storage.py 的 SCHEMA。
+
+-- BUY 的累计成本和累计数量，均价 = total_cost / total_qty (apply_cost_basis_delta / rebuild_cost_basis)
+create table if not exists public.cost_basis (
+    user_id    uuid not null,
+    symbol     text not null,
+    total_cost double precision not null default 0,
+    total_qty  double precision not null default 0,
+    primary key (user_id, symbol)
+);
+
+-- 每个 (交易所, 交易对) 已经同步到的最后成交时间 (毫秒)
+create table if not exists public.sync_watermarks (
+    user_id  uuid not null,
+    exchange text not null,
+    market   text not null,
+    last_ts  bigint,
+    primary key (user_id, exchange, market)
+);
+
+-- batch.py 的每日汇总，service role 写入
+create table if not exists public.user_snapshots (
+    user_id        uuid not null,
+    as_of          date not null,
+    net_worth      double precision,
+    cost           double precision,
+    pnl            double precision,
+    pnl_pct        double precision,
+    positions      integer,
+    realized_pnl   double precision,
+    tax_events     integer,
+    net_worth_goal double precision,
+    goal_pct       double precision,
+    computed_at    timestamptz,
+    primary key (user_id, as_of)
+);
+
+-- 账本按 (币种, 时间, id) / (时间, id) 翻页
+create index if not exists transactions_user_symbol_ts on public.transactions (user_id, symbol, timestamp, id);
+create index if not exists transactions_user_ts on public.transactions (user_id, timestamp, id);
+
+-- 和其他用户表一样，登录用户只能读写自己的行 (service role 不受 RLS 限制)
+alter table public.cost_basis enable row level security;
+alter table public.sync_watermarks enable row level security;
+alter table public.user_snapshots enable row level security;
+
+drop policy if exists "own rows" on public.cost_basis;
+create policy "own rows" on public.cost_basis
+    for all using (auth.uid() = user_id) with check (auth.uid() = user_id);
+drop policy if exists "own rows" on public.sync_watermarks;
+create policy "own rows" on public.sync_watermarks
+    for all using (auth.uid() = user_id) with check (auth.uid() = user_id);
+drop policy if exists "own rows" on public.user_snapshots;
+create policy "own rows" on public.user_snapshots
+    for select using (auth.uid() = user_id);